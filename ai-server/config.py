@@ -4,13 +4,15 @@ Handles model routing, server settings, and Excel integration parameters
 """
 
 import os
+import re
+from functools import lru_cache
 from typing import Dict, List, Optional, Literal
-from pydantic import Field
+from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings
 from pathlib import Path
 
 
-class AIModelConfig(BaseSettings):
+class AIModelConfig(BaseModel):
     """Configuration for individual AI models"""
     name: str
     type: Literal["large", "small"] 
@@ -72,8 +74,23 @@ class ServerConfig(BaseSettings):
     
     # Performance Settings Optimized for 8GB RAM
     model_cache_size: int = 2  # Reduced cache to save memory
+    response_cache_size: int = 256  # Endpoint responses kept for repeated requests
+    response_cache_ttl: int = 3600  # Seconds before a cached response expires
+    ai_response_cache_size: int = 512  # AI replies kept per formula/VBA engine, keyed by prompt
     concurrent_requests: int = 2  # Limit concurrent requests for stability
     request_queue_size: int = 20  # Smaller queue to reduce memory usage
+    http_max_connections: int = 16  # Pool size for provider HTTP connections
+    http_max_keepalive: int = 8  # Idle connections kept open for reuse
+    http_retries: int = 1  # Connection retries on transient connect errors
+    
+    # Origins allowed to call the API; the add-in is served from the dev server
+    # by default, add the production add-in URL via MANICE_CORS_ORIGINS
+    cors_origins: List[str] = [
+        "https://localhost:3000",
+        "https://127.0.0.1:3000",
+        "https://excel.officeapps.live.com"
+    ]
+    cors_max_age: int = 86400  # Seconds browsers may reuse a preflight response
     
     # Local Model Providers
     ollama_url: str = "http://127.0.0.1:11434"
@@ -81,6 +98,11 @@ class ServerConfig(BaseSettings):
     jan_url: str = "http://127.0.0.1:1337"
     preferred_provider: Literal["ollama", "lm_studio", "jan"] = "ollama"
     
+    @property
+    def ai_batch_max_tokens(self) -> int:
+        """Longest reply a batched engine request may ask for, whichever model serves it"""
+        return min(self.small_model.max_tokens, self.large_model.max_tokens)
+    
     class Config:
         env_prefix = "MANICE_"
         env_file = ".env"
@@ -112,11 +134,40 @@ class ExcelOperationConfig(BaseSettings):
         env_prefix = "MANICE_EXCEL_"
 
 
+@lru_cache(maxsize=1)
+def get_server_config() -> ServerConfig:
+    """Load server settings once per process"""
+    return ServerConfig()
+
+
+@lru_cache(maxsize=1)
+def get_excel_config() -> ExcelOperationConfig:
+    """Load Excel operation settings once per process"""
+    return ExcelOperationConfig()
+
+
 # Global configuration instances
-server_config = ServerConfig()
-excel_config = ExcelOperationConfig()
+server_config = get_server_config()
+excel_config = get_excel_config()
+
+
+def _compile_keywords(keywords: List[str]) -> "re.Pattern":
+    """Compile keywords into a single alternation that finds every occurrence"""
+    alternation = "|".join(re.escape(k) for k in sorted(keywords, key=len, reverse=True))
+    # Lookahead so overlapping keywords are still reported
+    return re.compile(f"(?=({alternation}))")
+
+
+# Context size (in characters) above which the large model is preferred
+LARGE_CONTEXT_SIZE = 5000
+
+# Keyword matchers built once at import instead of rescanned per keyword
+_LARGE_KEYWORDS_RE = _compile_keywords(server_config.large_model_keywords)
+_SMALL_KEYWORDS_RE = _compile_keywords(server_config.small_model_keywords)
+_REASONING_WORDS_RE = _compile_keywords(["because", "explain", "why", "how", "analyze"])
 
 
+@lru_cache(maxsize=1024)
 def get_model_for_task(task_description: str, context_size: int = 0) -> Literal["large", "small"]:
     """
     Determine which AI model to use based on task complexity
@@ -130,23 +181,21 @@ def get_model_for_task(task_description: str, context_size: int = 0) -> Literal[
     """
     task_lower = task_description.lower()
     
-    # Check for explicit large model keywords
-    large_score = sum(1 for keyword in server_config.large_model_keywords 
-                     if keyword in task_lower)
+    # Check for explicit large model keywords (each keyword counts once)
+    large_score = len(set(_LARGE_KEYWORDS_RE.findall(task_lower)))
     
     # Check for explicit small model keywords  
-    small_score = sum(1 for keyword in server_config.small_model_keywords
-                     if keyword in task_lower)
+    small_score = len(set(_SMALL_KEYWORDS_RE.findall(task_lower)))
     
     # Context size influence
-    if context_size > 5000:  # Large datasets need large model
+    if context_size > LARGE_CONTEXT_SIZE:  # Large datasets need large model
         large_score += 2
     
     # Length and complexity heuristics
     if len(task_description) > 200:  # Detailed requests
         large_score += 1
     
-    if any(word in task_lower for word in ["because", "explain", "why", "how", "analyze"]):
+    if _REASONING_WORDS_RE.search(task_lower):
         large_score += 1
         
     # Final decision
@@ -4,21 +4,24 @@ Handles communication with DeepSeek R1 and Mistral-7B models via local providers
 """
 
 import asyncio
+import hashlib
 import httpx
 import json
+import orjson
 import time
-from typing import Dict, List, Optional, Union, Any, AsyncGenerator
-from dataclasses import dataclass
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Union, Any, AsyncGenerator
+from dataclasses import dataclass, field
 from enum import Enum
 from loguru import logger
 
 try:
-    from ..config import server_config, AIModelConfig
+    from ..config import server_config, AIModelConfig, LARGE_CONTEXT_SIZE, get_model_for_task
 except ImportError:
-    from config import server_config, AIModelConfig
+    from config import server_config, AIModelConfig, LARGE_CONTEXT_SIZE, get_model_for_task
 
 
-class ModelProvider(Enum):
+class ModelProvider(str, Enum):
     """Supported local AI model providers"""
     OLLAMA = "ollama"
     LM_STUDIO = "lm_studio" 
@@ -44,21 +47,98 @@ class ExcelContext:
     cell_data: Optional[Dict[str, Any]] = None
     workbook_info: Optional[Dict[str, Any]] = None
     previous_operations: Optional[List[str]] = None
+    _json_cache: Dict[str, str] = field(default_factory=dict, init=False, repr=False, compare=False)
+    
+    def to_json(self, field_name: str) -> str:
+        """Serialize a context field as compact JSON, once per context"""
+        cached = self._json_cache.get(field_name)
+        if cached is None:
+            cached = orjson.dumps(getattr(self, field_name), option=orjson.OPT_NON_STR_KEYS).decode()
+            self._json_cache[field_name] = cached
+        return cached
+
+
+# Static prompt framing shared by every request. Everything request-specific
+# goes after it so local providers can reuse the KV cache for this prefix.
+_PROMPT_PREFIX = """You are Manice, an advanced Excel AI CoPilot assistant. You can:
+
+1. Read and analyze Excel data
+2. Modify cells, rows, columns, and formatting in real-time
+3. Create formulas and explain existing ones
+4. Generate charts and visualizations  
+5. Perform complex data analysis and business intelligence
+6. Convert natural language to Excel actions
+
+## Response Format:
+Provide a JSON response with these fields:
+{
+  "action": "excel_operation_type", 
+  "parameters": {...},
+  "explanation": "Human-readable explanation",
+  "excel_operations": [
+    {
+      "type": "cell_edit|formula|format|chart|etc",
+      "target": "A1:B10", 
+      "value": "...",
+      "options": {...}
+    }
+  ]
+}
+
+Be precise, actionable, and always consider Excel's capabilities and limitations.
+"""
+
+
+# System messages for the OpenAI-compatible providers
+_LM_STUDIO_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are Manice, an Excel AI assistant."
+}
+
+_JAN_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are Manice, a helpful Excel AI assistant."
+}
 
 
 class AIModelInterface:
     """Main interface for AI model communication"""
     
-    def __init__(self):
-        self.client = httpx.AsyncClient(timeout=60.0)
-        self.model_cache: Dict[str, ModelResponse] = {}
+    def __init__(self, client: Optional[httpx.AsyncClient] = None):
+        self._client = client
+        self.model_cache: "OrderedDict[str, ModelResponse]" = OrderedDict()
         self.request_history: List[str] = []
+        self._payload_templates: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Pooled HTTP client shared by all requests, created on first use"""
+        if self._client is None:
+            # Pool limits belong to the transport; the client ignores its own
+            # limits argument once a transport is supplied
+            self._client = httpx.AsyncClient(
+                timeout=60.0,
+                transport=httpx.AsyncHTTPTransport(
+                    retries=server_config.http_retries,
+                    limits=httpx.Limits(
+                        max_connections=server_config.http_max_connections,
+                        max_keepalive_connections=server_config.http_max_keepalive
+                    )
+                )
+            )
+        return self._client
+    
+    async def close(self):
+        """Close the pooled HTTP client and its keep-alive connections"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
         
     async def __aenter__(self):
         return self
         
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.client.aclose()
+        await self.close()
     
     async def generate_response(
         self, 
@@ -83,10 +163,6 @@ class AIModelInterface:
         
         # Determine model to use
         if not model_type:
-            try:
-                from ..config import get_model_for_task
-            except ImportError:
-                from config import get_model_for_task
             context_size = self._calculate_context_size(excel_context)
             model_type = get_model_for_task(prompt, context_size)
         
@@ -98,12 +174,15 @@ class AIModelInterface:
         # Build enhanced prompt with Excel context
         enhanced_prompt = self._build_enhanced_prompt(prompt, excel_context)
         
-        # Check cache first
-        cache_key = f"{model_type}:{hash(enhanced_prompt)}"
-        if cache_key in self.model_cache:
-            cached = self.model_cache[cache_key]
-            logger.info(f"Returning cached response for {model_type} model")
-            return cached
+        # Check cache first (streams are never cached)
+        cache_key = None
+        if not stream:
+            cache_key = f"{model_type}:{self._prompt_digest(enhanced_prompt)}"
+            if cache_key in self.model_cache:
+                cached = self.model_cache[cache_key]
+                self.model_cache.move_to_end(cache_key)
+                logger.info(f"Returning cached response for {model_type} model")
+                return cached
         
         # Generate response
         try:
@@ -122,7 +201,7 @@ class AIModelInterface:
             else:
                 raise ValueError(f"Unknown provider: {server_config.preferred_provider}")
             
-            if not stream:
+            if cache_key is not None:
                 # Cache successful responses
                 self.model_cache[cache_key] = response
                 self._cleanup_cache()
@@ -134,6 +213,28 @@ class AIModelInterface:
             # Fallback to alternative provider
             return await self._fallback_response(enhanced_prompt, model_config)
     
+    def _payload_template(self, provider: str, model_config: AIModelConfig) -> Dict[str, Any]:
+        """Per-model request fields that do not change between calls"""
+        key = (provider, model_config.name)
+        template = self._payload_templates.get(key)
+        if template is None:
+            if provider == "ollama":
+                template = {
+                    "model": model_config.model_path,
+                    "options": {
+                        "temperature": model_config.temperature,
+                        "num_predict": model_config.max_tokens
+                    }
+                }
+            else:
+                template = {
+                    "model": model_config.model_path,
+                    "temperature": model_config.temperature,
+                    "max_tokens": model_config.max_tokens
+                }
+            self._payload_templates[key] = template
+        return template
+    
     async def _query_ollama(
         self, 
         prompt: str, 
@@ -142,15 +243,12 @@ class AIModelInterface:
     ) -> ModelResponse:
         """Query Ollama API"""
         
-        payload = {
-            "model": model_config.model_path,
-            "prompt": prompt,
-            "options": {
-                "temperature": model_config.temperature,
-                "num_predict": model_config.max_tokens
-            },
-            "stream": stream
-        }
+        payload = dict(self._payload_template("ollama", model_config))
+        payload["prompt"] = prompt
+        payload["stream"] = stream
+        
+        if stream:
+            return self._handle_ollama_stream(payload, model_config)
         
         start_time = time.time()
         
@@ -161,24 +259,21 @@ class AIModelInterface:
                 timeout=model_config.timeout
             )
             response.raise_for_status()
+            result = orjson.loads(response.content)
             
-            if stream:
-                return self._handle_ollama_stream(response)
-            else:
-                result = response.json()
-                
-                return ModelResponse(
-                    content=result.get("response", ""),
-                    model_used=model_config.name,
-                    provider=ModelProvider.OLLAMA,
-                    tokens_used=result.get("eval_count", 0),
-                    response_time=time.time() - start_time,
-                    metadata={
-                        "total_duration": result.get("total_duration", 0),
-                        "load_duration": result.get("load_duration", 0),
-                        "eval_duration": result.get("eval_duration", 0)
-                    }
-                )
+            return ModelResponse(
+                content=result.get("response", ""),
+                model_used=model_config.name,
+                provider=ModelProvider.OLLAMA,
+                tokens_used=result.get("eval_count", 0),
+                response_time=time.time() - start_time,
+                metadata={
+                    "prompt_eval_count": result.get("prompt_eval_count", 0),
+                    "total_duration": result.get("total_duration", 0),
+                    "load_duration": result.get("load_duration", 0),
+                    "eval_duration": result.get("eval_duration", 0)
+                }
+            )
                 
         except httpx.RequestError as e:
             logger.error(f"Ollama request failed: {e}")
@@ -195,22 +290,12 @@ class AIModelInterface:
     ) -> ModelResponse:
         """Query LM Studio API"""
         
-        payload = {
-            "model": model_config.model_path,
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "You are Manice, an Excel AI assistant."
-                },
-                {
-                    "role": "user", 
-                    "content": prompt
-                }
-            ],
-            "temperature": model_config.temperature,
-            "max_tokens": model_config.max_tokens,
-            "stream": stream
-        }
+        payload = dict(self._payload_template("lm_studio", model_config))
+        payload["messages"] = [_LM_STUDIO_SYSTEM_MESSAGE, {"role": "user", "content": prompt}]
+        payload["stream"] = stream
+        
+        if stream:
+            return self._handle_lm_studio_stream(payload, model_config)
         
         start_time = time.time()
         
@@ -221,26 +306,70 @@ class AIModelInterface:
                 timeout=model_config.timeout
             )
             response.raise_for_status()
+            result = orjson.loads(response.content)
+            message = result["choices"][0]["message"]["content"]
             
-            if stream:
-                return self._handle_lm_studio_stream(response)
-            else:
-                result = response.json()
-                message = result["choices"][0]["message"]["content"]
-                
-                return ModelResponse(
-                    content=message,
-                    model_used=model_config.name,
-                    provider=ModelProvider.LM_STUDIO,
-                    tokens_used=result.get("usage", {}).get("total_tokens", 0),
-                    response_time=time.time() - start_time,
-                    metadata=result.get("usage", {})
-                )
+            return ModelResponse(
+                content=message,
+                model_used=model_config.name,
+                provider=ModelProvider.LM_STUDIO,
+                tokens_used=result.get("usage", {}).get("total_tokens", 0),
+                response_time=time.time() - start_time,
+                metadata=result.get("usage", {})
+            )
                 
         except Exception as e:
             logger.error(f"LM Studio request failed: {e}")
             raise
     
+    async def _handle_ollama_stream(
+        self,
+        payload: Dict[str, Any],
+        model_config: AIModelConfig
+    ) -> AsyncGenerator[str, None]:
+        """Yield tokens from Ollama's NDJSON stream as each frame arrives"""
+        async with self.client.stream(
+            "POST",
+            f"{server_config.ollama_url}/api/generate",
+            json=payload,
+            timeout=model_config.timeout
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                frame = orjson.loads(line)
+                chunk = frame.get("response")
+                if chunk:
+                    yield chunk
+                if frame.get("done"):
+                    break
+    
+    async def _handle_lm_studio_stream(
+        self,
+        payload: Dict[str, Any],
+        model_config: AIModelConfig
+    ) -> AsyncGenerator[str, None]:
+        """Yield tokens from LM Studio's OpenAI-style SSE stream"""
+        async with self.client.stream(
+            "POST",
+            f"{server_config.lm_studio_url}/v1/chat/completions",
+            json=payload,
+            timeout=model_config.timeout
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                frame = orjson.loads(data)
+                choices = frame.get("choices") or [{}]
+                chunk = choices[0].get("delta", {}).get("content")
+                if chunk:
+                    yield chunk
+    
     async def _query_jan(
         self, 
         prompt: str, 
@@ -250,22 +379,9 @@ class AIModelInterface:
         """Query Jan API"""
         
         # Jan uses OpenAI-compatible API
-        payload = {
-            "model": model_config.model_path,
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "You are Manice, a helpful Excel AI assistant."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            "temperature": model_config.temperature,
-            "max_tokens": model_config.max_tokens,
-            "stream": stream
-        }
+        payload = dict(self._payload_template("jan", model_config))
+        payload["messages"] = [_JAN_SYSTEM_MESSAGE, {"role": "user", "content": prompt}]
+        payload["stream"] = stream
         
         start_time = time.time()
         
@@ -277,7 +393,7 @@ class AIModelInterface:
             )
             response.raise_for_status()
             
-            result = response.json()
+            result = orjson.loads(response.content)
             message = result["choices"][0]["message"]["content"]
             
             return ModelResponse(
@@ -296,75 +412,64 @@ class AIModelInterface:
     def _build_enhanced_prompt(self, prompt: str, context: Optional[ExcelContext]) -> str:
         """Build enhanced prompt with Excel context"""
         
-        enhanced = f"""You are Manice, an advanced Excel AI CoPilot assistant. You can:
-
-1. Read and analyze Excel data
-2. Modify cells, rows, columns, and formatting in real-time
-3. Create formulas and explain existing ones
-4. Generate charts and visualizations  
-5. Perform complex data analysis and business intelligence
-6. Convert natural language to Excel actions
-
-Current task: {prompt}
-"""
+        parts = [_PROMPT_PREFIX]
         
         if context:
-            enhanced += f"\n## Excel Context:\n"
+            parts.append("\n## Excel Context:\n")
             
             if context.sheet_name:
-                enhanced += f"- Active Sheet: {context.sheet_name}\n"
+                parts.append(f"- Active Sheet: {context.sheet_name}\n")
                 
             if context.selected_range:
-                enhanced += f"- Selected Range: {context.selected_range}\n"
+                parts.append(f"- Selected Range: {context.selected_range}\n")
                 
             if context.cell_data:
-                enhanced += f"- Cell Data: {json.dumps(context.cell_data, indent=2)}\n"
+                parts.append(f"- Cell Data: {context.to_json('cell_data')}\n")
                 
             if context.workbook_info:
-                enhanced += f"- Workbook Info: {json.dumps(context.workbook_info, indent=2)}\n"
+                parts.append(f"- Workbook Info: {context.to_json('workbook_info')}\n")
                 
             if context.previous_operations:
-                enhanced += f"- Previous Operations: {context.previous_operations}\n"
+                parts.append(f"- Previous Operations: {context.previous_operations}\n")
         
-        enhanced += """\n
-## Response Format:
-Provide a JSON response with these fields:
-{
-  "action": "excel_operation_type", 
-  "parameters": {...},
-  "explanation": "Human-readable explanation",
-  "excel_operations": [
-    {
-      "type": "cell_edit|formula|format|chart|etc",
-      "target": "A1:B10", 
-      "value": "...",
-      "options": {...}
-    }
-  ]
-}
-
-Be precise, actionable, and always consider Excel's capabilities and limitations.
-"""
+        parts.append("\nCurrent task: ")
+        parts.append(prompt)
+        parts.append("\n")
         
-        return enhanced
+        return "".join(parts)
+    
+    @staticmethod
+    def _prompt_digest(prompt: str) -> str:
+        """Stable 128-bit digest of a prompt, consistent across processes"""
+        return hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).hexdigest()
     
     def _calculate_context_size(self, context: Optional[ExcelContext]) -> int:
         """Calculate approximate context size for model selection"""
         if not context:
             return 0
             
+        # Routing only compares against LARGE_CONTEXT_SIZE, so stop counting
+        # once it is exceeded and report a fixed value to keep routing cacheable
+        limit = LARGE_CONTEXT_SIZE + 1
         size = 0
         
+        if context.previous_operations:
+            for op in context.previous_operations:
+                size += len(op)
+                if size >= limit:
+                    return limit
+        
+        # Reuses the serialization that _build_enhanced_prompt needs anyway; compact
+        # JSON stays close to the str() lengths LARGE_CONTEXT_SIZE was tuned on
         if context.cell_data:
-            size += len(str(context.cell_data))
+            size += len(context.to_json("cell_data"))
+            if size >= limit:
+                return limit
             
         if context.workbook_info:
-            size += len(str(context.workbook_info))
-            
-        if context.previous_operations:
-            size += sum(len(op) for op in context.previous_operations)
+            size += len(context.to_json("workbook_info"))
             
-        return size
+        return min(size, limit)
     
     async def _fallback_response(self, prompt: str, model_config: AIModelConfig) -> ModelResponse:
         """Fallback response when primary provider fails"""
@@ -386,11 +491,9 @@ Be precise, actionable, and always consider Excel's capabilities and limitations
     
     def _cleanup_cache(self):
         """Clean up model response cache to prevent memory issues"""
-        if len(self.model_cache) > server_config.model_cache_size:
-            # Remove oldest entries
-            keys_to_remove = list(self.model_cache.keys())[:-server_config.model_cache_size]
-            for key in keys_to_remove:
-                del self.model_cache[key]
+        # Evict least recently used entries
+        while len(self.model_cache) > server_config.model_cache_size:
+            self.model_cache.popitem(last=False)
     
     async def health_check(self) -> Dict[str, Any]:
         """Check health of AI models and providers"""
@@ -401,27 +504,34 @@ Be precise, actionable, and always consider Excel's capabilities and limitations
             "timestamp": time.time()
         }
         
-        # Check each provider
-        for provider in ["ollama", "lm_studio", "jan"]:
-            try:
-                if provider == "ollama":
-                    url = f"{server_config.ollama_url}/api/tags"
-                else:
-                    url = f"{getattr(server_config, f'{provider}_url')}/v1/models"
-                
-                response = await self.client.get(url, timeout=5.0)
-                health["providers"][provider] = {
-                    "available": response.status_code == 200,
-                    "response_time": response.elapsed.total_seconds()
-                }
-                
-            except Exception as e:
-                health["providers"][provider] = {
-                    "available": False,
-                    "error": str(e)
-                }
+        # Probe all providers concurrently
+        results = await asyncio.gather(
+            *(self._probe_provider(provider) for provider in ("ollama", "lm_studio", "jan"))
+        )
+        for provider, info in results:
+            health["providers"][provider] = info
         
         return health
+    
+    async def _probe_provider(self, provider: str) -> Tuple[str, Dict[str, Any]]:
+        """Check whether a single provider endpoint is reachable"""
+        try:
+            if provider == "ollama":
+                url = f"{server_config.ollama_url}/api/tags"
+            else:
+                url = f"{getattr(server_config, f'{provider}_url')}/v1/models"
+            
+            response = await self.client.get(url, timeout=5.0)
+            return provider, {
+                "available": response.status_code == 200,
+                "response_time": response.elapsed.total_seconds()
+            }
+            
+        except Exception as e:
+            return provider, {
+                "available": False,
+                "error": str(e)
+            }
 
 
 # Singleton instance
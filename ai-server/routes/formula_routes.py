@@ -3,25 +3,89 @@ Formula and VBA API Routes for Manice Excel AI Copilot
 Provides endpoints for formula generation, debugging, and VBA macro creation
 """
 
+import hashlib
 import json
 import time
-from typing import Dict, List, Optional, Any
-from fastapi import APIRouter, HTTPException, Depends
+from typing import Callable, Dict, List, Optional, Tuple, Any
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
 from pydantic import BaseModel, Field
 from loguru import logger
+import orjson
 
 try:
-    from ..services.formula_engine import FormulaGenerator, FormulaDebugger, FormulaResult, FormulaError
+    from ..services.formula_engine import (
+        FormulaGenerator, FormulaDebugger, FormulaResult, FormulaError, track_ai_fallbacks
+    )
     from ..services.vba_engine import VBAMacroEngine, VBAMacro, MacroAnalysis
+    from ..services.response_cache import ResponseCache, SingleFlight
+    from ..services.ai_adapter import AITextAdapter
     from ..models import get_ai_interface
+    from ..config import server_config
 except ImportError:
-    from services.formula_engine import FormulaGenerator, FormulaDebugger, FormulaResult, FormulaError
+    from services.formula_engine import (
+        FormulaGenerator, FormulaDebugger, FormulaResult, FormulaError, track_ai_fallbacks
+    )
     from services.vba_engine import VBAMacroEngine, VBAMacro, MacroAnalysis
+    from services.response_cache import ResponseCache, SingleFlight
+    from services.ai_adapter import AITextAdapter
     from models import get_ai_interface
+    from config import server_config
 
 # Create router
 router = APIRouter(prefix="/api/v1", tags=["Formula & VBA"])
 
+# Successful formula responses, keyed by endpoint and request content; results
+# built while an AI step fell back to local output are not kept
+formula_cache = ResponseCache(
+    max_size=server_config.response_cache_size,
+    ttl=server_config.response_cache_ttl
+)
+
+# Explanations depend only on the formula text, so they are kept without expiry
+# and apart from generation traffic that would otherwise evict them. Only
+# explanations and examples that both came from the model are stored.
+EXPLANATION_CACHE_SIZE = 2048
+explanation_cache = ResponseCache(max_size=EXPLANATION_CACHE_SIZE, ttl=float("inf"))
+
+# Identical generation requests that arrive together share one engine call
+inflight = SingleFlight()
+
+def _cached_response(
+    cache_key: str,
+    http_response: Response,
+    cache: ResponseCache = formula_cache
+) -> Optional[BaseModel]:
+    """Return a fresh copy of a cached response and tag the X-Cache header"""
+    cached = cache.get(cache_key)
+    if cached is None:
+        http_response.headers["X-Cache"] = "MISS"
+        return None
+    http_response.headers["X-Cache"] = "HIT"
+    return cached.model_copy(update={"timestamp": time.time()})
+
+# Encoded catalog bodies and their ETags, keyed by endpoint and category.
+# The function library and VBA templates are fixed once the engines load.
+_catalog_bodies: Dict[Tuple[str, str], Tuple[bytes, str]] = {}
+
+def _catalog_response(
+    key: Tuple[str, str],
+    build: Callable[[], Dict[str, Any]],
+    request: Request
+) -> Response:
+    """Serve a static catalog body, answering 304 when the client's ETag matches"""
+    entry = _catalog_bodies.get(key)
+    if entry is None:
+        body = orjson.dumps(build())
+        entry = (body, f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"')
+        _catalog_bodies[key] = entry
+    
+    body, etag = entry
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=3600"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 # Pydantic Models
 class FormulaRequest(BaseModel):
     """Request model for formula generation"""
@@ -35,6 +99,10 @@ class FormulaDebugRequest(BaseModel):
     error_message: Optional[str] = Field(None, description="Error message if any")
     cell_data: Optional[Dict[str, Any]] = Field(None, description="Cell data context")
 
+class FormulaBatchValidationRequest(BaseModel):
+    """Request model for bulk formula validation"""
+    formulas: List[str] = Field(..., description="Excel formulas to validate")
+
 class VBARequest(BaseModel):
     """Request model for VBA macro generation"""
     requirement: str = Field(..., description="Natural language requirement for the macro")
@@ -80,25 +148,38 @@ class VBAResponse(BaseModel):
     timestamp: float = Field(default_factory=time.time)
 
 # Dependencies
+# Engines are built once and shared, since they only hold static reference data.
+# They take plain reply text, which the adapter pulls out of the model interface.
+_formula_generator: Optional[FormulaGenerator] = None
+_formula_debugger: Optional[FormulaDebugger] = None
+_vba_engine: Optional[VBAMacroEngine] = None
+
 async def get_formula_generator():
-    """Get formula generator instance"""
-    ai_service = await get_ai_interface()
-    return FormulaGenerator(ai_service)
+    """Get shared formula generator instance"""
+    global _formula_generator
+    if _formula_generator is None:
+        _formula_generator = FormulaGenerator(AITextAdapter(await get_ai_interface()))
+    return _formula_generator
 
 async def get_formula_debugger():
-    """Get formula debugger instance"""
-    ai_service = await get_ai_interface()
-    return FormulaDebugger(ai_service)
+    """Get shared formula debugger instance"""
+    global _formula_debugger
+    if _formula_debugger is None:
+        _formula_debugger = FormulaDebugger(AITextAdapter(await get_ai_interface()))
+    return _formula_debugger
 
 async def get_vba_engine():
-    """Get VBA engine instance"""
-    ai_service = await get_ai_interface()
-    return VBAMacroEngine(ai_service)
+    """Get shared VBA engine instance"""
+    global _vba_engine
+    if _vba_engine is None:
+        _vba_engine = VBAMacroEngine(AITextAdapter(await get_ai_interface()))
+    return _vba_engine
 
 # Formula Generation Endpoints
 @router.post("/formula/generate", response_model=FormulaResponse)
 async def generate_formula(
     request: FormulaRequest,
+    http_response: Response,
     generator: FormulaGenerator = Depends(get_formula_generator)
 ):
     """
@@ -106,14 +187,24 @@ async def generate_formula(
     """
     logger.info(f"Generating formula for: {request.requirement[:100]}...")
     
+    cache_key = formula_cache.make_key("generate", request.requirement, request.context, request.data_sample)
+    cached = _cached_response(cache_key, http_response)
+    if cached is not None:
+        return cached
+    
+    async def generate() -> Tuple[FormulaResult, bool]:
+        with track_ai_fallbacks() as fallbacks:
+            result = await generator.generate_formula(
+                requirement=request.requirement,
+                context=request.context,
+                data_sample=request.data_sample
+            )
+        return result, bool(fallbacks)
+    
     try:
-        result = await generator.generate_formula(
-            requirement=request.requirement,
-            context=request.context,
-            data_sample=request.data_sample
-        )
+        result, degraded = await inflight.run(cache_key, generate)
         
-        return FormulaResponse(
+        response = FormulaResponse(
             success=True,
             formula=result.formula,
             explanation=result.explanation,
@@ -124,6 +215,9 @@ async def generate_formula(
             prerequisites=result.prerequisites,
             confidence=result.confidence
         )
+        if not degraded:
+            formula_cache.set(cache_key, response)
+        return response
         
     except Exception as e:
         logger.error(f"Formula generation failed: {e}")
@@ -135,6 +229,7 @@ async def generate_formula(
 @router.post("/formula/debug", response_model=FormulaResponse)
 async def debug_formula(
     request: FormulaDebugRequest,
+    http_response: Response,
     debugger: FormulaDebugger = Depends(get_formula_debugger)
 ):
     """
@@ -142,25 +237,32 @@ async def debug_formula(
     """
     logger.info(f"Debugging formula: {request.formula}")
     
+    cache_key = formula_cache.make_key("debug", request.formula, request.error_message, request.cell_data)
+    cached = _cached_response(cache_key, http_response)
+    if cached is not None:
+        return cached
+    
     try:
-        result = await debugger.debug_formula(
-            formula=request.formula,
-            error_message=request.error_message,
-            cell_data=request.cell_data
-        )
+        with track_ai_fallbacks() as fallbacks:
+            result = await debugger.debug_formula(
+                formula=request.formula,
+                error_message=request.error_message,
+                cell_data=request.cell_data
+            )
         
         # Convert errors to dict format
-        errors = []
-        for error in result["errors"]:
-            errors.append({
+        errors = [
+            {
                 "type": error.error_type,
                 "location": error.location,
                 "description": error.description,
                 "suggestion": error.suggestion,
                 "severity": error.severity
-            })
+            }
+            for error in result["errors"]
+        ]
         
-        return FormulaResponse(
+        response = FormulaResponse(
             success=True,
             formula=result["corrected_formula"],
             explanation=f"Analysis completed. Found {len(errors)} issues.",
@@ -168,6 +270,9 @@ async def debug_formula(
             solutions=result["solutions"],
             optimizations=result["optimizations"]
         )
+        if not fallbacks:
+            formula_cache.set(cache_key, response)
+        return response
         
     except Exception as e:
         logger.error(f"Formula debugging failed: {e}")
@@ -176,9 +281,22 @@ async def debug_formula(
             explanation=f"Error debugging formula: {str(e)}"
         )
 
+async def _explain(generator: FormulaGenerator, formula: str) -> Tuple[str, List[str], bool]:
+    """
+    Use the AI service to explain the formula and produce usage examples
+    
+    The flag is set when either part is local placeholder text because the AI
+    step failed.
+    """
+    with track_ai_fallbacks() as fallbacks:
+        explanation = await generator._generate_explanation(formula, f"Explain: {formula}", {})
+        examples = await generator._generate_examples(formula)
+    return explanation, examples, bool(fallbacks)
+
 @router.post("/formula/explain", response_model=FormulaResponse)
 async def explain_formula(
     formula: str,
+    http_response: Response,
     generator: FormulaGenerator = Depends(get_formula_generator)
 ):
     """
@@ -186,17 +304,26 @@ async def explain_formula(
     """
     logger.info(f"Explaining formula: {formula}")
     
+    cache_key = explanation_cache.make_key("explain", formula)
+    cached = _cached_response(cache_key, http_response, explanation_cache)
+    if cached is not None:
+        return cached
+    
     try:
-        # Use the AI service to explain the formula
-        explanation = await generator._generate_explanation(formula, f"Explain: {formula}", {})
-        examples = await generator._generate_examples(formula)
+        explanation, examples, degraded = await inflight.run(
+            cache_key,
+            lambda: _explain(generator, formula)
+        )
         
-        return FormulaResponse(
+        response = FormulaResponse(
             success=True,
             formula=formula,
             explanation=explanation,
             examples=examples
         )
+        if not degraded:
+            explanation_cache.set(cache_key, response)
+        return response
         
     except Exception as e:
         logger.error(f"Formula explanation failed: {e}")
@@ -205,6 +332,24 @@ async def explain_formula(
             explanation=f"Error explaining formula: {str(e)}"
         )
 
+@router.post("/formula/validate", response_model=Dict[str, Any])
+async def validate_formulas(
+    request: FormulaBatchValidationRequest,
+    generator: FormulaGenerator = Depends(get_formula_generator)
+):
+    """
+    Validate a batch of formulas, e.g. from a full workbook scan
+    """
+    logger.info(f"Validating {len(request.formulas)} formulas")
+    
+    try:
+        results = generator.validate_formulas_batch(request.formulas)
+        return {"success": True, "results": results}
+        
+    except Exception as e:
+        logger.error(f"Batch formula validation failed: {e}")
+        return {"success": False, "results": [], "error": str(e)}
+
 # VBA Macro Endpoints
 @router.post("/vba/generate", response_model=VBAResponse)
 async def generate_vba_macro(
@@ -217,10 +362,14 @@ async def generate_vba_macro(
     logger.info(f"Generating VBA macro for: {request.requirement[:100]}...")
     
     try:
-        macro = await vba_engine.generate_macro(
-            requirement=request.requirement,
-            context=request.context,
-            constraints=request.constraints
+        flight_key = ResponseCache.make_key("vba", request.requirement, request.context, request.constraints)
+        macro = await inflight.run(
+            flight_key,
+            lambda: vba_engine.generate_macro(
+                requirement=request.requirement,
+                context=request.context,
+                constraints=request.constraints
+            )
         )
         
         return VBAResponse(
@@ -319,6 +468,7 @@ async def optimize_vba_macro(
 # Utility Endpoints
 @router.get("/formula/functions", response_model=Dict[str, Any])
 async def get_excel_functions(
+    request: Request,
     category: Optional[str] = None,
     generator: FormulaGenerator = Depends(get_formula_generator)
 ):
@@ -326,21 +476,25 @@ async def get_excel_functions(
     Get list of available Excel functions
     """
     try:
-        functions = generator.function_library
-        
         if category:
-            # Filter by category
-            filtered = {}
-            for func_name, func_info in functions.items():
-                if func_info.get("category", "").value.lower() == category.lower():
-                    filtered[func_name] = func_info
-            functions = filtered
+            # Unknown categories share one empty body so the cache stays bounded
+            category_key = category.lower()
+            if category_key not in generator.functions_by_category:
+                category_key = "?"
+            functions = generator.functions_by_category.get(category_key, {})
+        else:
+            category_key = ""
+            functions = generator.function_library
         
-        return {
-            "success": True,
-            "functions": functions,
-            "count": len(functions)
-        }
+        return _catalog_response(
+            ("functions", category_key),
+            lambda: {
+                "success": True,
+                "functions": functions,
+                "count": len(functions)
+            },
+            request
+        )
         
     except Exception as e:
         logger.error(f"Error retrieving functions: {e}")
@@ -351,6 +505,7 @@ async def get_excel_functions(
 
 @router.get("/vba/templates", response_model=Dict[str, Any])
 async def get_vba_templates(
+    request: Request,
     category: Optional[str] = None,
     vba_engine: VBAMacroEngine = Depends(get_vba_engine)
 ):
@@ -360,14 +515,20 @@ async def get_vba_templates(
     try:
         templates = vba_engine.vba_templates
         
+        category_key = ""
         if category and category in templates:
+            category_key = category
             templates = {category: templates[category]}
         
-        return {
-            "success": True,
-            "templates": templates,
-            "categories": list(templates.keys())
-        }
+        return _catalog_response(
+            ("templates", category_key),
+            lambda: {
+                "success": True,
+                "templates": templates,
+                "categories": list(templates.keys())
+            },
+            request
+        )
         
     except Exception as e:
         logger.error(f"Error retrieving VBA templates: {e}")
@@ -4,27 +4,41 @@ Main FastAPI application for Excel AI CoPilot with real-time integration
 """
 
 import asyncio
-import json
+import itertools
 import time
-import traceback
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import AsyncGenerator, AsyncIterator, Dict, List, Optional, Any
 
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from loguru import logger
+import orjson
 import uvicorn
 
 try:
     from config import server_config, excel_config
     from models import get_ai_interface, ExcelContext, ModelResponse
-    from routes.formula_routes import router as formula_router
+    from routes.formula_routes import (
+        router as formula_router,
+        get_formula_generator,
+        get_formula_debugger,
+        get_vba_engine
+    )
+    from services.response_cache import ResponseCache, SingleFlight
+    from services.json_stream import ArrayItemStream
 except ImportError:
     from .config import server_config, excel_config
     from .models import get_ai_interface, ExcelContext, ModelResponse
-    from .routes.formula_routes import router as formula_router
+    from .routes.formula_routes import (
+        router as formula_router,
+        get_formula_generator,
+        get_formula_debugger,
+        get_vba_engine
+    )
+    from .services.response_cache import ResponseCache, SingleFlight
+    from .services.json_stream import ArrayItemStream
 
 
 # Pydantic Models for API
@@ -76,10 +90,11 @@ app = FastAPI(
 # CORS middleware for Excel add-in communication
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # In production, restrict to Excel origins
+    allow_origins=server_config.cors_origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=server_config.cors_max_age,
 )
 
 # Include routers
@@ -87,8 +102,43 @@ app.include_router(formula_router)
 
 # Global state
 server_start_time = time.time()
+request_ids = itertools.count(1)
 request_count = 0
 active_requests = 0
+manice_cache = ResponseCache(
+    max_size=server_config.response_cache_size,
+    ttl=server_config.response_cache_ttl
+)
+manice_inflight = SingleFlight()
+
+# Provider probes are network round-trips; reuse the result across
+# closely spaced liveness/readiness checks
+HEALTH_CACHE_TTL = 5.0
+health_cache = ResponseCache(max_size=1, ttl=HEALTH_CACHE_TTL)
+
+# Bodies that never change after startup are encoded once
+_ROOT_BYTES = orjson.dumps({
+    "service": "Manice AI Server",
+    "status": "running",
+    "version": "1.0.0",
+    "docs": "/docs" if server_config.debug else "disabled"
+})
+_MODELS_INFO = {
+    "large_model": server_config.large_model.model_dump(),
+    "small_model": server_config.small_model.model_dump()
+}
+_CONFIGURATION_INFO = {
+    "server": server_config.model_dump(),
+    "excel": excel_config.model_dump()
+}
+_STATS_CONFIGURATION = {
+    "debug": server_config.debug,
+    "models": {
+        "large": server_config.large_model.name,
+        "small": server_config.small_model.name
+    },
+    "provider": server_config.preferred_provider
+}
 
 
 @app.middleware("http")
@@ -97,31 +147,48 @@ async def logging_middleware(request, call_next):
     global request_count, active_requests
     
     start_time = time.time()
-    request_count += 1
+    request_id = request_count = next(request_ids)
     active_requests += 1
     
     try:
         response = await call_next(request)
         process_time = time.time() - start_time
         
-        logger.info(
-            f"{request.method} {request.url.path} - "
-            f"Status: {response.status_code} - "
-            f"Time: {process_time:.3f}s"
+        # Lazy arguments skip URL and message formatting when INFO is filtered
+        logger.opt(lazy=True).info(
+            "{} {} - Status: {} - Time: {:.3f}s",
+            lambda: request.method,
+            lambda: request.url.path,
+            lambda: response.status_code,
+            lambda: process_time
         )
         
         response.headers["X-Process-Time"] = str(process_time)
-        response.headers["X-Request-ID"] = str(request_count)
+        response.headers["X-Request-ID"] = str(request_id)
         
         return response
         
     except Exception as e:
-        logger.error(f"Request failed: {e}")
+        logger.error("Request failed: {}", e)
         raise
     finally:
         active_requests -= 1
 
 
+def _build_context(context: Optional[Dict[str, Any]]) -> Optional[ExcelContext]:
+    """Build the Excel context for the AI service from a request context dict"""
+    if not context:
+        return None
+    get = context.get
+    return ExcelContext(
+        sheet_name=get("sheet_name"),
+        selected_range=get("selected_range"),
+        cell_data=get("cell_data"),
+        workbook_info=get("workbook_info"),
+        previous_operations=get("previous_operations", [])
+    )
+
+
 # Dependency to get AI interface
 async def get_ai_service():
     """Dependency to get AI interface"""
@@ -131,12 +198,7 @@ async def get_ai_service():
 @app.get("/", response_model=Dict[str, str])
 async def root():
     """Root endpoint"""
-    return {
-        "service": "Manice AI Server",
-        "status": "running",
-        "version": "1.0.0",
-        "docs": "/docs" if server_config.debug else "disabled"
-    }
+    return Response(content=_ROOT_BYTES, media_type="application/json")
 
 
 @app.get("/health", response_model=HealthResponse)
@@ -145,17 +207,17 @@ async def health_check(ai_service=Depends(get_ai_service)):
     
     try:
         # Get AI model health
-        ai_health = await ai_service.health_check()
+        ai_health = health_cache.get("providers")
+        if ai_health is None:
+            ai_health = await ai_service.health_check()
+            health_cache.set("providers", ai_health)
         
         return HealthResponse(
             status="healthy",
             version="1.0.0",
             uptime=time.time() - server_start_time,
             providers=ai_health.get("providers", {}),
-            models={
-                "large_model": server_config.large_model.dict(),
-                "small_model": server_config.small_model.dict()
-            },
+            models=_MODELS_INFO,
             timestamp=time.time()
         )
         
@@ -174,6 +236,7 @@ async def health_check(ai_service=Depends(get_ai_service)):
 @app.post("/manice", response_model=ManiceResponse)
 async def process_manice_request(
     request: ManiceRequest,
+    http_response: Response,
     ai_service=Depends(get_ai_service)
 ):
     """
@@ -183,30 +246,31 @@ async def process_manice_request(
     
     logger.info(f"Processing request: {request.instruction[:100]}...")
     
+    cache_key = manice_cache.make_key(request.instruction, request.force_model, request.context)
+    cached = manice_cache.get(cache_key)
+    if cached is not None:
+        http_response.headers["X-Cache"] = "HIT"
+        return cached.model_copy(update={"timestamp": time.time()})
+    http_response.headers["X-Cache"] = "MISS"
+    
     try:
-        # Build Excel context from request
-        excel_context = None
-        if request.context:
-            excel_context = ExcelContext(
-                sheet_name=request.context.get("sheet_name"),
-                selected_range=request.context.get("selected_range"),
-                cell_data=request.context.get("cell_data"),
-                workbook_info=request.context.get("workbook_info"),
-                previous_operations=request.context.get("previous_operations", [])
-            )
+        excel_context = _build_context(request.context)
         
-        # Generate AI response
-        model_response = await ai_service.generate_response(
-            prompt=request.instruction,
-            model_type=request.force_model,
-            excel_context=excel_context,
-            stream=False  # Non-streaming for now
+        # Generate AI response, sharing it with identical concurrent requests
+        model_response = await manice_inflight.run(
+            cache_key,
+            lambda: ai_service.generate_response(
+                prompt=request.instruction,
+                model_type=request.force_model,
+                excel_context=excel_context,
+                stream=False  # Non-streaming for now
+            )
         )
         
         # Parse AI response
         try:
-            ai_content = json.loads(model_response.content)
-        except json.JSONDecodeError:
+            ai_content = orjson.loads(model_response.content)
+        except orjson.JSONDecodeError:
             # Fallback if AI doesn't return valid JSON
             ai_content = {
                 "action": "text_response",
@@ -214,31 +278,35 @@ async def process_manice_request(
                 "excel_operations": []
             }
         
-        # Build response
-        response = ManiceResponse(
-            action=ai_content.get("action", "unknown"),
-            explanation=ai_content.get("explanation", "Action completed"),
-            excel_operations=[
-                ExcelOperation(**op) for op in ai_content.get("excel_operations", [])
-            ],
-            parameters=ai_content.get("parameters"),
-            model_info={
+        # Build response; the model output is validated in a single pass,
+        # including the nested operations
+        response = ManiceResponse.model_validate({
+            "action": ai_content.get("action", "unknown"),
+            "explanation": ai_content.get("explanation", "Action completed"),
+            "excel_operations": ai_content.get("excel_operations", []),
+            "parameters": ai_content.get("parameters"),
+            "model_info": {
                 "model_used": model_response.model_used,
                 "provider": model_response.provider.value,
                 "tokens_used": model_response.tokens_used,
+                "prompt_tokens_evaluated": model_response.metadata.get("prompt_eval_count"),
                 "response_time": model_response.response_time
             }
-        )
+        })
+        
+        # Fallback responses mean the model was unavailable, so don't keep them
+        if not model_response.metadata.get("fallback"):
+            manice_cache.set(cache_key, response)
         
         logger.info(f"Request completed successfully using {model_response.model_used}")
         return response
         
     except Exception as e:
-        logger.error(f"Error processing request: {e}")
-        logger.error(traceback.format_exc())
+        # Full tracebacks only in debug; loguru formats them when a sink emits
+        logger.opt(exception=server_config.debug).error("Error processing request: {}", e)
         
-        # Return error response
-        return ManiceResponse(
+        # Return error response (built from trusted values, no validation needed)
+        return ManiceResponse.model_construct(
             action="error",
             explanation=f"An error occurred: {str(e)}",
             excel_operations=[],
@@ -246,6 +314,79 @@ async def process_manice_request(
         )
 
 
+_SSE_PREFIX = b"data: "
+_SSE_SUFFIX = b"\n\n"
+_SSE_DONE = _SSE_PREFIX + orjson.dumps({"done": True}) + _SSE_SUFFIX
+
+# Flush thresholds for batching small SSE frames into fewer socket writes
+SSE_FLUSH_BYTES = 4096
+SSE_FLUSH_DELAY = 0.02
+SSE_QUEUE_SIZE = 64
+
+
+async def _coalesce_frames(frames: AsyncGenerator[bytes, None]) -> AsyncIterator[bytes]:
+    """
+    Merge SSE frames into larger writes, flushing once the buffer exceeds
+    SSE_FLUSH_BYTES or its oldest frame has waited SSE_FLUSH_DELAY seconds.
+    The bounded queue stops the producer when the client reads slowly.
+    """
+    queue: "asyncio.Queue[Optional[bytes]]" = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+
+    async def produce():
+        cancelled = False
+        try:
+            async for frame in frames:
+                await queue.put(frame)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # Closes the upstream generator and the provider stream it holds
+            await frames.aclose()
+            # After a client disconnect nothing reads the queue, so no end marker
+            if not cancelled:
+                await queue.put(None)
+
+    producer = asyncio.ensure_future(produce())
+    loop = asyncio.get_running_loop()
+    buffer = bytearray()
+    deadline = None
+
+    try:
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            try:
+                frame = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                yield bytes(buffer)
+                buffer.clear()
+                deadline = None
+                continue
+
+            if frame is None:
+                break
+
+            if not buffer:
+                deadline = loop.time() + SSE_FLUSH_DELAY
+            buffer += frame
+
+            if len(buffer) >= SSE_FLUSH_BYTES:
+                yield bytes(buffer)
+                buffer.clear()
+                deadline = None
+
+        if buffer:
+            yield bytes(buffer)
+    finally:
+        producer.cancel()
+        try:
+            await producer
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Stream producer failed: {e}")
+
+
 @app.post("/manice/stream")
 async def stream_manice_request(
     request: ManiceRequest,
@@ -260,18 +401,9 @@ async def stream_manice_request(
     
     logger.info(f"Starting stream for: {request.instruction[:100]}...")
     
-    async def generate_stream():
+    async def generate_stream() -> AsyncGenerator[bytes, None]:
         try:
-            # Build Excel context
-            excel_context = None
-            if request.context:
-                excel_context = ExcelContext(
-                    sheet_name=request.context.get("sheet_name"),
-                    selected_range=request.context.get("selected_range"),
-                    cell_data=request.context.get("cell_data"),
-                    workbook_info=request.context.get("workbook_info"),
-                    previous_operations=request.context.get("previous_operations", [])
-                )
+            excel_context = _build_context(request.context)
             
             # Generate streaming response
             async for chunk in await ai_service.generate_response(
@@ -280,16 +412,74 @@ async def stream_manice_request(
                 excel_context=excel_context,
                 stream=True
             ):
-                yield f"data: {json.dumps({'chunk': chunk})}\n\n"
+                yield _SSE_PREFIX + orjson.dumps({"chunk": chunk}) + _SSE_SUFFIX
                 
         except Exception as e:
             logger.error(f"Streaming error: {e}")
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            yield _SSE_PREFIX + orjson.dumps({"error": str(e)}) + _SSE_SUFFIX
+        
+        yield _SSE_DONE
+    
+    return StreamingResponse(
+        _coalesce_frames(generate_stream()),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+        }
+    )
+
+
+@app.post("/manice/operations")
+async def stream_manice_operations(
+    request: ManiceRequest,
+    ai_service=Depends(get_ai_service)
+):
+    """
+    Streaming endpoint that emits each Excel operation as soon as the model
+    finishes writing it, followed by the action and explanation
+    """
+    
+    logger.info(f"Streaming operations for: {request.instruction[:100]}...")
+    
+    async def generate_operations() -> AsyncGenerator[bytes, None]:
+        parser = ArrayItemStream("excel_operations")
+        try:
+            excel_context = _build_context(request.context)
+            
+            async for chunk in await ai_service.generate_response(
+                prompt=request.instruction,
+                model_type=request.force_model,
+                excel_context=excel_context,
+                stream=True
+            ):
+                for item in parser.feed(chunk):
+                    try:
+                        operation = ExcelOperation.model_validate(item)
+                    except ValidationError as e:
+                        logger.warning(f"Skipping invalid operation: {e}")
+                        continue
+                    yield _SSE_PREFIX + orjson.dumps({"operation": operation.model_dump()}) + _SSE_SUFFIX
+            
+            # Remaining fields are only known once the document is complete
+            ai_content = parser.document() or {
+                "action": "text_response",
+                "explanation": parser.text
+            }
+            yield _SSE_PREFIX + orjson.dumps({
+                "action": ai_content.get("action", "unknown"),
+                "explanation": ai_content.get("explanation", "Action completed"),
+                "parameters": ai_content.get("parameters")
+            }) + _SSE_SUFFIX
+            
+        except Exception as e:
+            logger.error(f"Operation streaming error: {e}")
+            yield _SSE_PREFIX + orjson.dumps({"error": str(e)}) + _SSE_SUFFIX
         
-        yield f"data: {json.dumps({'done': True})}\n\n"
+        yield _SSE_DONE
     
     return StreamingResponse(
-        generate_stream(),
+        _coalesce_frames(generate_operations()),
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
@@ -298,6 +488,30 @@ async def stream_manice_request(
     )
 
 
+def _simulate_operation(operation: ExcelOperation, operation_id: str) -> Dict[str, Any]:
+    """Run a single Excel operation, reporting failures as an error result"""
+    try:
+        # This is where we would integrate with Excel COM/JS API
+        # For now, we'll simulate the operation
+        return {
+            "operation_id": operation_id,
+            "type": operation.type,
+            "target": operation.target,
+            "status": "simulated",  # Would be "success" or "error" in real implementation
+            "message": f"Simulated {operation.type} on {operation.target}"
+        }
+        
+    except Exception as e:
+        logger.error(f"Operation failed: {e}")
+        return {
+            "operation_id": operation_id,
+            "type": operation.type,
+            "target": operation.target,
+            "status": "error",
+            "message": str(e)
+        }
+
+
 @app.post("/excel/operation")
 async def execute_excel_operation(
     operations: List[ExcelOperation],
@@ -310,31 +524,12 @@ async def execute_excel_operation(
     
     logger.info(f"Executing {len(operations)} Excel operations")
     
-    results = []
-    
-    for operation in operations:
-        try:
-            # This is where we would integrate with Excel COM/JS API
-            # For now, we'll simulate the operation
-            result = {
-                "operation_id": f"op_{int(time.time() * 1000)}",
-                "type": operation.type,
-                "target": operation.target,
-                "status": "simulated",  # Would be "success" or "error" in real implementation
-                "message": f"Simulated {operation.type} on {operation.target}"
-            }
-            
-            results.append(result)
-            
-        except Exception as e:
-            logger.error(f"Operation failed: {e}")
-            results.append({
-                "operation_id": f"op_{int(time.time() * 1000)}",
-                "type": operation.type,
-                "target": operation.target,
-                "status": "error",
-                "message": str(e)
-            })
+    # Operations are simulated in-process, so there is no I/O to overlap
+    timestamp_ms = int(time.time() * 1000)
+    results = [
+        _simulate_operation(operation, f"op_{timestamp_ms}_{index}")
+        for index, operation in enumerate(operations)
+    ]
     
     return {"operations": results, "timestamp": time.time()}
 
@@ -346,14 +541,7 @@ async def get_server_stats():
         "uptime": time.time() - server_start_time,
         "requests_total": request_count,
         "active_requests": active_requests,
-        "configuration": {
-            "debug": server_config.debug,
-            "models": {
-                "large": server_config.large_model.name,
-                "small": server_config.small_model.name
-            },
-            "provider": server_config.preferred_provider
-        },
+        "configuration": _STATS_CONFIGURATION,
         "timestamp": time.time()
     }
 
@@ -364,10 +552,7 @@ async def get_configuration():
     if not server_config.debug:
         raise HTTPException(status_code=404, detail="Not found")
     
-    return {
-        "server": server_config.dict(),
-        "excel": excel_config.dict()
-    }
+    return _CONFIGURATION_INFO
 
 
 # Error handlers
@@ -397,8 +582,11 @@ async def startup_event():
     logger.info(f"Large model: {server_config.large_model.name}")
     logger.info(f"Small model: {server_config.small_model.name}")
     
-    # Initialize AI interface
+    # Initialize AI interface and the shared engines
     ai_service = await get_ai_interface()
+    await get_formula_generator()
+    await get_formula_debugger()
+    await get_vba_engine()
     health = await ai_service.health_check()
     logger.info(f"AI service health: {health['status']}")
 
@@ -407,6 +595,10 @@ async def startup_event():
 async def shutdown_event():
     """Cleanup on shutdown"""
     logger.info("Shutting down Manice AI Server...")
+    
+    # Release pooled connections to the model providers
+    ai_service = await get_ai_interface()
+    await ai_service.close()
 
 
 def main():
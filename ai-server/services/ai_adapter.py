@@ -0,0 +1,32 @@
+"""
+AI Text Adapter for Manice Excel AI Copilot
+Gives the formula and VBA engines the prompt-in, text-out call they are written against
+"""
+
+from typing import Any, Optional
+
+
+class AIUnavailableError(RuntimeError):
+    """The model interface answered with its canned fallback instead of a model reply"""
+
+
+class AITextAdapter:
+    """
+    Expose AIModelInterface as generate_response(prompt, max_tokens) -> str
+
+    The interface sizes replies from the routed model's configuration, so
+    max_tokens is accepted for the engines' sake but not forwarded. When no
+    provider could answer, the interface returns a canned error reply marked
+    as a fallback; that is raised instead, so the engines take their local
+    fallbacks and their caches never store the canned text.
+    """
+
+    def __init__(self, ai_interface: Any):
+        self.ai_interface = ai_interface
+
+    async def generate_response(self, prompt: str, max_tokens: Optional[int] = None) -> str:
+        """Return the model's reply text for prompt"""
+        response = await self.ai_interface.generate_response(prompt)
+        if response.metadata.get("fallback"):
+            raise AIUnavailableError("AI model temporarily unavailable")
+        return response.content
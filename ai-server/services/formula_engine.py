@@ -3,12 +3,115 @@ Formula Generation Engine for Manice Excel AI Copilot
 Provides AI-powered formula generation, debugging, and optimization
 """
 
-from typing import Dict, List, Optional, Any, Union
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Iterator, List, NamedTuple, Optional, Tuple, Union
+import asyncio
 import re
-import json
+import difflib
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
 from dataclasses import dataclass
 from enum import Enum
 from loguru import logger
+import numpy as np
+import orjson
+
+from .json_stream import decode_first
+from .micro_batch import MicroBatcher
+from .response_cache import ResponseCache, SingleFlight
+
+try:
+    from ..config import server_config
+except ImportError:
+    from config import server_config
+
+# Precompiled patterns for formula and requirement scanning
+_RE_FUNCS = re.compile(r'[A-Z]+(?=\()')
+_RE_RANGE_IN_REQ = re.compile(r'[A-Z]\d+:[A-Z]\d+|[A-Z]:[A-Z]')
+_RE_WORDS = re.compile(r'\b\w+\b')
+_RE_DIVISION = re.compile(r'([A-Z\d:]+)/([A-Z\d:]+)')
+
+# Formula scanner tokens: an uppercase run with an optional cell reference and
+# range tail, or a single structural character. Everything else is skipped by
+# the regex engine rather than the Python loop.
+_RE_FORMULA_TOKEN = re.compile(r'([A-Z]+)(?:(\d+)(?::([A-Z]+\d+))?)?|[(){}"\n+\-*/^&<>=]')
+_RE_CALL_AHEAD = re.compile(r'\s*\(')
+
+# A1-style cell reference as a standalone token, and the same with string
+# literals matched first so references inside quotes can be skipped
+_CELL_REF = r'(?<![A-Za-z0-9_$.])(\$?)([A-Z]{1,3})(\$?)(\d+)(?![A-Za-z0-9_(])'
+_RE_CELL_REF = re.compile(_CELL_REF)
+_RE_FORMULA_CELL_REF = re.compile(r'"[^"]*"|' + _CELL_REF)
+_RE_REFERENCE_SLOT = re.compile(r'\0(\d+)\0')
+
+# Function names whose presence anywhere in a formula triggers lookup handling
+_RE_FUNCTION_TRIGGERS = re.compile(r'VLOOKUP|HLOOKUP|INDEX|MATCH')
+
+# Requirement keywords, matched against whole words rather than substrings
+_SUM_WORDS = frozenset({'sum', 'sums', 'add', 'total', 'totals'})
+_COUNT_WORDS = frozenset({'count', 'counts'})
+_LOOKUP_WORDS = frozenset({'lookup', 'vlookup', 'hlookup', 'xlookup', 'find', 'search'})
+_AVERAGE_WORDS = frozenset({'average', 'averages', 'mean'})
+_CONDITIONAL_WORDS = frozenset({'if', 'condition', 'conditions', 'when'})
+_CONDITION_WORDS = _CONDITIONAL_WORDS | {'where'}
+
+# Requirement substrings that raise the complexity estimate
+_NESTING_TERMS = ('nested', 'multiple', 'several')
+_ARRAY_TERMS = ('unique', 'sort', 'filter', 'array')
+_COMPLEX_FUNCTION_TERMS = ('vlookup', 'index', 'match', 'indirect', 'offset')
+
+# Functions that need newer Excel versions, and others valid beyond the library
+_EXCEL_365_FUNCTIONS = frozenset({'XLOOKUP'})
+_DYNAMIC_ARRAY_FUNCTIONS = frozenset({'UNIQUE', 'SORT', 'SORTBY', 'FILTER'})
+_MODERN_FUNCTIONS = frozenset({'XLOOKUP', 'XMATCH', 'UNIQUE', 'SORT', 'FILTER', 'SEQUENCE', 'RANDARRAY'})
+
+# Concurrent AI error detections sent to the model as one request
+ERROR_DETECTION_BATCH_SIZE = 16
+ERROR_DETECTION_BATCH_DELAY = 0.01
+ERROR_DETECTION_MAX_TOKENS = 500
+
+# AI replies at least this long are decoded in a worker thread; shorter ones
+# parse faster than the hand-off to the executor
+AI_JSON_OFFLOAD_CHARS = 64 * 1024
+
+# Pure per-formula analyses memoized by formula text; fill-down copies repeat often
+FORMULA_ANALYSIS_CACHE_SIZE = 4096
+
+# Distinct AI findings kept per debugger for sharing between formulas
+INTERNED_ERRORS_SIZE = 4096
+
+# Operation names produced by requirement analysis, indexed against function names
+_OPERATION_NAMES = ('sum', 'count', 'lookup', 'average', 'conditional')
+
+def _prompt_json(value: Any) -> str:
+    """Serialize a value compactly for a prompt; enums are written by value"""
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+
+# AI steps that fell back to local output, for callers tracking the current request
+_ai_fallbacks: "ContextVar[Optional[List[str]]]" = ContextVar("ai_fallbacks", default=None)
+
+@contextmanager
+def track_ai_fallbacks() -> Iterator[List[str]]:
+    """
+    Collect the names of AI steps that fall back to local output inside the block
+    
+    Tasks started in the block share the list, so steps run concurrently are
+    recorded as well. Results built while any step fell back are degraded and
+    should not be cached.
+    """
+    fallbacks: List[str] = []
+    token = _ai_fallbacks.set(fallbacks)
+    try:
+        yield fallbacks
+    finally:
+        _ai_fallbacks.reset(token)
+
+def _note_ai_fallback(step: str) -> None:
+    """Record a fallback for the tracking caller, if there is one"""
+    fallbacks = _ai_fallbacks.get()
+    if fallbacks is not None:
+        fallbacks.append(step)
 
 class FormulaComplexity(Enum):
     SIMPLE = "simple"
@@ -28,8 +131,25 @@ class FormulaCategory(Enum):
     DATABASE = "database"
     CUSTOM = "custom"
 
-@dataclass
+# Main operation from requirement analysis -> formula category
+_CATEGORY_BY_OPERATION = {
+    "sum": FormulaCategory.MATH,
+    "count": FormulaCategory.STATISTICAL,
+    "average": FormulaCategory.STATISTICAL,
+    "lookup": FormulaCategory.LOOKUP,
+    "conditional": FormulaCategory.LOGICAL,
+    "text": FormulaCategory.TEXT,
+    "date": FormulaCategory.DATE,
+    "financial": FormulaCategory.FINANCIAL
+}
+
+# Results are built in one construction call and never mutated. Slots are
+# declared by hand because dataclass(slots=True) needs Python 3.10.
+@dataclass(frozen=True)
 class FormulaResult:
+    __slots__ = ('formula', 'explanation', 'category', 'complexity',
+                 'examples', 'prerequisites', 'alternatives', 'confidence')
+    
     formula: str
     explanation: str
     category: FormulaCategory
@@ -40,149 +160,367 @@ class FormulaResult:
     confidence: float
 
 @dataclass
-class FormulaError:
+class RequirementScan:
+    """Keyword features of a requirement collected in one pass"""
+    __slots__ = ('analysis', 'mentions_nesting', 'keyword_score')
+    
+    analysis: Dict[str, Any]
+    mentions_nesting: bool
+    keyword_score: int
+
+@dataclass(frozen=True)
+class ReferenceScan:
+    """Cell references of a formula collected in one scan"""
+    __slots__ = ('shape', 'structure', 'cells')
+    
+    shape: Dict[str, str]
+    structure: str
+    cells: List[str]
+
+@dataclass
+class FormulaTokens:
+    """Structural features of a formula collected in one scan"""
+    __slots__ = ('functions', 'cell_references', 'range_references', 'operators', 'open_parentheses',
+                 'parentheses_balanced', 'has_nested_functions', 'has_conditions', 'has_arrays')
+    
+    functions: List[str]
+    cell_references: List[str]
+    range_references: List[str]
+    operators: List[str]
+    open_parentheses: int
+    parentheses_balanced: bool
+    has_nested_functions: bool
+    has_conditions: bool
+    has_arrays: bool
+
+def _tokenize_formula(formula: str) -> FormulaTokens:
+    """
+    Walk the formula once, collecting function names, references, operators
+    and structural flags. Matches the semantics of the function, reference,
+    operator, nesting, IF and array-literal patterns without rescanning.
+    Parentheses balance ignores string literals and fails on a ')' with no
+    matching '(' before it.
+    """
+    functions = []
+    cell_references = []
+    range_references = []
+    operators = []
+    open_parentheses = 0
+    depth = 0
+    in_string = False
+    misordered = False
+    has_nested = has_conditions = has_arrays = False
+    # A function call has opened with no ')' seen since, for nesting checks
+    call_open = False
+    # A '{' has been seen on the current line, for array literal checks
+    brace_open = False
+    
+    length = len(formula)
+    for match in _RE_FORMULA_TOKEN.finditer(formula):
+        letters = match.group(1)
+        if letters is not None:
+            if match.group(2) is not None:
+                # Cell reference, possibly the start of a range
+                range_end = match.group(3)
+                if range_end is None:
+                    cell_references.append(match.group())
+                else:
+                    range_references.append(match.group())
+                    cell_references.append(letters + match.group(2))
+                    cell_references.append(range_end)
+                continue
+            
+            end = match.end()
+            if letters.endswith('IF') and _RE_CALL_AHEAD.match(formula, end):
+                has_conditions = True
+            
+            if end < length and formula[end] == '(':
+                functions.append(letters)
+                if call_open:
+                    has_nested = True
+                call_open = True
+            continue
+        
+        char = match.group()
+        if char == '(':
+            open_parentheses += 1
+            if not in_string:
+                depth += 1
+        elif char == ')':
+            call_open = False
+            if not in_string:
+                depth -= 1
+                if depth < 0:
+                    misordered = True
+        elif char == '"':
+            # Excel escapes quotes by doubling them, which toggles twice
+            in_string = not in_string
+        elif char in '+-*/^&<>=':
+            operators.append(char)
+        elif char == '{':
+            brace_open = True
+        elif char == '}':
+            if brace_open:
+                has_arrays = True
+        elif char == '\n':
+            brace_open = False
+    
+    return FormulaTokens(
+        functions=functions,
+        cell_references=cell_references,
+        range_references=range_references,
+        operators=operators,
+        open_parentheses=open_parentheses,
+        parentheses_balanced=depth == 0 and not misordered,
+        has_nested_functions=has_nested,
+        has_conditions=has_conditions,
+        has_arrays=has_arrays
+    )
+
+@lru_cache(maxsize=FORMULA_ANALYSIS_CACHE_SIZE)
+def _formula_prerequisites(formula: str) -> Tuple[str, ...]:
+    """Excel version and feature requirements implied by a formula"""
+    prerequisites = []
+    functions = frozenset(_RE_FUNCS.findall(formula))
+    
+    # Check for advanced functions
+    if functions & _EXCEL_365_FUNCTIONS:
+        prerequisites.append("Excel 365 or Excel 2021")
+    if functions & _DYNAMIC_ARRAY_FUNCTIONS:
+        prerequisites.append("Excel 365 with dynamic arrays")
+    if 'LAMBDA' in functions:
+        prerequisites.append("Excel 365 with LAMBDA function support")
+    
+    # Check for complex features
+    if '[]' in formula:
+        prerequisites.append("Dynamic array formulas enabled")
+    if 'INDIRECT' in functions:
+        prerequisites.append("Be cautious with file links and references")
+    
+    return tuple(prerequisites)
+
+@lru_cache(maxsize=FORMULA_ANALYSIS_CACHE_SIZE)
+def _function_triggers(formula: str) -> FrozenSet[str]:
+    """Trigger function names found in a formula, collected in one regex pass"""
+    return frozenset(_RE_FUNCTION_TRIGGERS.findall(formula))
+
+@lru_cache(maxsize=FORMULA_ANALYSIS_CACHE_SIZE)
+def _formula_structure(formula: str) -> Dict[str, Any]:
+    """Structural analysis of a formula; callers must not mutate the shared result"""
+    tokens = _tokenize_formula(formula)
+    analysis = {
+        "functions": tokens.functions,
+        "cell_references": tokens.cell_references,
+        "range_references": tokens.range_references,
+        "operators": tokens.operators,
+        "parentheses_count": tokens.open_parentheses,
+        "parentheses_balanced": tokens.parentheses_balanced,
+        "has_nested_functions": tokens.has_nested_functions,
+        "complexity_score": len(tokens.functions) + tokens.open_parentheses
+    }
+    
+    # Check for common patterns
+    analysis["has_conditions"] = tokens.has_conditions
+    analysis["has_lookups"] = bool(_function_triggers(formula))
+    analysis["has_arrays"] = tokens.has_arrays
+    
+    return analysis
+
+class FormulaError(NamedTuple):
+    # A plain tuple: built for every finding, and cheaper to create than a frozen dataclass
     error_type: str
     location: Optional[str]
     description: str
     suggestion: str
     severity: str
 
+# Common Excel formula patterns and templates; static, so shared by all generators
+_FORMULA_PATTERNS = {
+    "lookup": {
+        "vlookup": "=VLOOKUP({lookup_value}, {table_array}, {col_index}, {range_lookup})",
+        "index_match": "=INDEX({return_array}, MATCH({lookup_value}, {lookup_array}, 0))",
+        "xlookup": "=XLOOKUP({lookup_value}, {lookup_array}, {return_array})"
+    },
+    "conditional": {
+        "if_simple": "=IF({condition}, {value_if_true}, {value_if_false})",
+        "if_nested": "=IF({condition1}, {value1}, IF({condition2}, {value2}, {value3}))",
+        "ifs": "=IFS({condition1}, {value1}, {condition2}, {value2}, TRUE, {default})"
+    },
+    "aggregation": {
+        "sum_if": "=SUMIF({range}, {criteria}, {sum_range})",
+        "count_if": "=COUNTIF({range}, {criteria})",
+        "average_if": "=AVERAGEIF({range}, {criteria}, {average_range})"
+    },
+    "text": {
+        "concatenate": "=CONCAT({text1}, {text2})",
+        "text_join": "=TEXTJOIN({delimiter}, {ignore_empty}, {text1}, {text2})",
+        "substitute": "=SUBSTITUTE({text}, {old_text}, {new_text})"
+    },
+    "date_time": {
+        "date_diff": "=DATEDIF({start_date}, {end_date}, {unit})",
+        "workday": "=WORKDAY({start_date}, {days}, {holidays})",
+        "today": "=TODAY()"
+    },
+    "array": {
+        "unique": "=UNIQUE({array})",
+        "sort": "=SORT({array}, {sort_index}, {sort_order})",
+        "filter": "=FILTER({array}, {include})"
+    }
+}
+
+# Excel function library with descriptions; static, so shared by all generators
+_FUNCTION_LIBRARY = {
+    "SUM": {
+        "description": "Adds numbers in a range",
+        "syntax": "SUM(number1, [number2], ...)",
+        "examples": ["=SUM(A1:A10)", "=SUM(A1, B1, C1)"],
+        "category": FormulaCategory.MATH
+    },
+    "VLOOKUP": {
+        "description": "Looks up a value in the first column and returns a value in the same row from another column",
+        "syntax": "VLOOKUP(lookup_value, table_array, col_index_num, [range_lookup])",
+        "examples": ["=VLOOKUP(A2, B:D, 3, FALSE)"],
+        "category": FormulaCategory.LOOKUP
+    },
+    "INDEX": {
+        "description": "Returns a value from a table based on row and column numbers",
+        "syntax": "INDEX(array, row_num, [column_num])",
+        "examples": ["=INDEX(A1:C10, 5, 2)"],
+        "category": FormulaCategory.LOOKUP
+    },
+    "MATCH": {
+        "description": "Searches for a specified item and returns its relative position",
+        "syntax": "MATCH(lookup_value, lookup_array, [match_type])",
+        "examples": ["=MATCH(\"Apple\", A1:A10, 0)"],
+        "category": FormulaCategory.LOOKUP
+    },
+    "IF": {
+        "description": "Returns one value if condition is TRUE, another if FALSE",
+        "syntax": "IF(logical_test, value_if_true, [value_if_false])",
+        "examples": ["=IF(A1>10, \"High\", \"Low\")"],
+        "category": FormulaCategory.LOGICAL
+    },
+    "CONCATENATE": {
+        "description": "Joins several text strings into one text string",
+        "syntax": "CONCATENATE(text1, [text2], ...)",
+        "examples": ["=CONCATENATE(A1, \" \", B1)"],
+        "category": FormulaCategory.TEXT
+    },
+    "COUNTIF": {
+        "description": "Counts cells that meet a criteria",
+        "syntax": "COUNTIF(range, criteria)",
+        "examples": ["=COUNTIF(A1:A10, \">5\")"],
+        "category": FormulaCategory.STATISTICAL
+    },
+    "SUMIF": {
+        "description": "Adds cells that meet a criteria",
+        "syntax": "SUMIF(range, criteria, [sum_range])",
+        "examples": ["=SUMIF(A1:A10, \">5\", B1:B10)"],
+        "category": FormulaCategory.MATH
+    },
+    "AVERAGE": {
+        "description": "Returns the average of numbers",
+        "syntax": "AVERAGE(number1, [number2], ...)",
+        "examples": ["=AVERAGE(A1:A10)"],
+        "category": FormulaCategory.STATISTICAL
+    },
+    "TODAY": {
+        "description": "Returns today's date",
+        "syntax": "TODAY()",
+        "examples": ["=TODAY()"],
+        "category": FormulaCategory.DATE
+    }
+}
+
 class FormulaGenerator:
     """AI-powered Excel formula generation and analysis"""
     
-    def __init__(self, ai_service):
+    def __init__(self, ai_service: Any) -> None:
         self.ai_service = ai_service
         self.formula_patterns = self._load_formula_patterns()
         self.function_library = self._load_function_library()
+        self.functions_by_category = self._index_functions_by_category()
+        self.functions_by_operation = self._index_functions_by_operation()
+        self.function_snippets = self._index_function_snippets()
+        self.reference_prompts = self._index_reference_prompts()
+        self.known_functions = frozenset(self.function_library) | _MODERN_FUNCTIONS
+        self._ai_cache = ResponseCache(
+            max_size=server_config.ai_response_cache_size, ttl=server_config.response_cache_ttl
+        )
+        self._ai_inflight = SingleFlight()
         
     def _load_formula_patterns(self) -> Dict:
         """Load common Excel formula patterns and templates"""
-        return {
-            "lookup": {
-                "vlookup": "=VLOOKUP({lookup_value}, {table_array}, {col_index}, {range_lookup})",
-                "index_match": "=INDEX({return_array}, MATCH({lookup_value}, {lookup_array}, 0))",
-                "xlookup": "=XLOOKUP({lookup_value}, {lookup_array}, {return_array})"
-            },
-            "conditional": {
-                "if_simple": "=IF({condition}, {value_if_true}, {value_if_false})",
-                "if_nested": "=IF({condition1}, {value1}, IF({condition2}, {value2}, {value3}))",
-                "ifs": "=IFS({condition1}, {value1}, {condition2}, {value2}, TRUE, {default})"
-            },
-            "aggregation": {
-                "sum_if": "=SUMIF({range}, {criteria}, {sum_range})",
-                "count_if": "=COUNTIF({range}, {criteria})",
-                "average_if": "=AVERAGEIF({range}, {criteria}, {average_range})"
-            },
-            "text": {
-                "concatenate": "=CONCAT({text1}, {text2})",
-                "text_join": "=TEXTJOIN({delimiter}, {ignore_empty}, {text1}, {text2})",
-                "substitute": "=SUBSTITUTE({text}, {old_text}, {new_text})"
-            },
-            "date_time": {
-                "date_diff": "=DATEDIF({start_date}, {end_date}, {unit})",
-                "workday": "=WORKDAY({start_date}, {days}, {holidays})",
-                "today": "=TODAY()"
-            },
-            "array": {
-                "unique": "=UNIQUE({array})",
-                "sort": "=SORT({array}, {sort_index}, {sort_order})",
-                "filter": "=FILTER({array}, {include})"
-            }
-        }
+        return _FORMULA_PATTERNS
     
     def _load_function_library(self) -> Dict:
         """Load Excel function library with descriptions"""
+        return _FUNCTION_LIBRARY
+    
+    def _index_functions_by_category(self) -> Dict[str, Dict]:
+        """Group function library entries by lowercase category value"""
+        index: Dict[str, Dict] = {}
+        for func_name, func_info in self.function_library.items():
+            index.setdefault(func_info["category"].value.lower(), {})[func_name] = func_info
+        return index
+    
+    def _index_functions_by_operation(self) -> Dict[str, List[str]]:
+        """Map each known operation name to the functions whose names contain it"""
         return {
-            "SUM": {
-                "description": "Adds numbers in a range",
-                "syntax": "SUM(number1, [number2], ...)",
-                "examples": ["=SUM(A1:A10)", "=SUM(A1, B1, C1)"],
-                "category": FormulaCategory.MATH
-            },
-            "VLOOKUP": {
-                "description": "Looks up a value in the first column and returns a value in the same row from another column",
-                "syntax": "VLOOKUP(lookup_value, table_array, col_index_num, [range_lookup])",
-                "examples": ["=VLOOKUP(A2, B:D, 3, FALSE)"],
-                "category": FormulaCategory.LOOKUP
-            },
-            "INDEX": {
-                "description": "Returns a value from a table based on row and column numbers",
-                "syntax": "INDEX(array, row_num, [column_num])",
-                "examples": ["=INDEX(A1:C10, 5, 2)"],
-                "category": FormulaCategory.LOOKUP
-            },
-            "MATCH": {
-                "description": "Searches for a specified item and returns its relative position",
-                "syntax": "MATCH(lookup_value, lookup_array, [match_type])",
-                "examples": ["=MATCH(\"Apple\", A1:A10, 0)"],
-                "category": FormulaCategory.LOOKUP
-            },
-            "IF": {
-                "description": "Returns one value if condition is TRUE, another if FALSE",
-                "syntax": "IF(logical_test, value_if_true, [value_if_false])",
-                "examples": ["=IF(A1>10, \"High\", \"Low\")"],
-                "category": FormulaCategory.LOGICAL
-            },
-            "CONCATENATE": {
-                "description": "Joins several text strings into one text string",
-                "syntax": "CONCATENATE(text1, [text2], ...)",
-                "examples": ["=CONCATENATE(A1, \" \", B1)"],
-                "category": FormulaCategory.TEXT
-            },
-            "COUNTIF": {
-                "description": "Counts cells that meet a criteria",
-                "syntax": "COUNTIF(range, criteria)",
-                "examples": ["=COUNTIF(A1:A10, \">5\")"],
-                "category": FormulaCategory.STATISTICAL
-            },
-            "SUMIF": {
-                "description": "Adds cells that meet a criteria",
-                "syntax": "SUMIF(range, criteria, [sum_range])",
-                "examples": ["=SUMIF(A1:A10, \">5\", B1:B10)"],
-                "category": FormulaCategory.MATH
-            },
-            "AVERAGE": {
-                "description": "Returns the average of numbers",
-                "syntax": "AVERAGE(number1, [number2], ...)",
-                "examples": ["=AVERAGE(A1:A10)"],
-                "category": FormulaCategory.STATISTICAL
-            },
-            "TODAY": {
-                "description": "Returns today's date",
-                "syntax": "TODAY()",
-                "examples": ["=TODAY()"],
-                "category": FormulaCategory.DATE
-            }
+            operation: [name for name in self.function_library if operation in name.lower()]
+            for operation in _OPERATION_NAMES
         }
     
+    async def _ask_ai(self, prompt: str, max_tokens: int) -> Any:
+        """Query the AI service, reusing the answer for a prompt already asked or in flight"""
+        cache_key = ResponseCache.make_key(prompt, max_tokens)
+        cached = self._ai_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        response = await self._ai_inflight.run(
+            cache_key,
+            lambda: self.ai_service.generate_response(prompt, max_tokens=max_tokens)
+        )
+        self._ai_cache.set(cache_key, response)
+        return response
+    
     async def generate_formula(self, 
                              requirement: str, 
                              context: Optional[Dict] = None,
                              data_sample: Optional[Dict] = None) -> FormulaResult:
         """Generate Excel formula based on natural language requirement"""
         try:
+            # Local keyword analysis runs once and backs every later step
+            scan = self._analyze_local(requirement)
+            
+            # One combined AI request covers every step when the model cooperates
+            bundled = await self._generate_formula_bundle(requirement, scan, context, data_sample)
+            if bundled is not None:
+                return bundled
+            
             # Analyze the requirement
-            analysis = await self._analyze_requirement(requirement, context)
+            analysis = await self._analyze_requirement(requirement, scan, context)
             
             # Determine formula category and complexity
-            category = self._determine_category(requirement, analysis)
-            complexity = self._determine_complexity(requirement, analysis)
+            category = self._determine_category(analysis)
+            complexity = self._determine_complexity(analysis, scan)
             
             # Generate formula using AI
             formula = await self._generate_formula_ai(requirement, analysis, category, complexity, data_sample)
             
             # Validate and optimize formula
-            validated_formula = await self._validate_formula(formula)
+            validated_formula = self._validate_formula(formula)
             
-            # Generate explanation and examples
-            explanation = await self._generate_explanation(validated_formula, requirement, analysis)
-            examples = await self._generate_examples(validated_formula, context)
-            
-            # Find alternatives
-            alternatives = await self._find_alternatives(validated_formula, requirement, category)
+            # Explanation, examples and alternatives are independent AI calls; overlap them
+            explanation, examples, alternatives = await asyncio.gather(
+                self._generate_explanation(validated_formula, requirement, analysis),
+                self._generate_examples(validated_formula, context),
+                self._find_alternatives(validated_formula, requirement, category)
+            )
             
             # Calculate confidence score
-            confidence = await self._calculate_confidence(validated_formula, requirement, analysis)
+            confidence = self._calculate_confidence(validated_formula, requirement, analysis)
             
             return FormulaResult(
                 formula=validated_formula,
@@ -199,13 +537,83 @@ class FormulaGenerator:
             logger.error(f"Error generating formula: {str(e)}")
             raise
     
-    async def _analyze_requirement(self, requirement: str, context: Optional[Dict] = None) -> Dict:
-        """Analyze natural language requirement to understand intent"""
+    async def _generate_formula_bundle(self,
+                                       requirement: str,
+                                       scan: RequirementScan,
+                                       context: Optional[Dict] = None,
+                                       data_sample: Optional[Dict] = None) -> Optional[FormulaResult]:
+        """Generate formula, explanation, examples and alternatives in one AI call"""
+        # Local analysis picks the reference material; the AI refines it
+        local_analysis = scan.analysis
+        local_category = self._determine_category(local_analysis)
+        
         prompt = f"""
-        Analyze this Excel formula requirement and extract key information:
+        Generate an Excel formula for the requirement below and describe it.
+        
+        Return a single JSON object with exactly these fields:
+        - "analysis": object with "main_operation" (sum, count, lookup, average, conditional, text, date or financial), "operations" (list), "has_conditions" (boolean)
+        - "formula": a valid Excel formula starting with =, as simple as possible while handling edge cases
+        - "explanation": what the formula does and how it works, in plain English
+        - "examples": list of up to 3 practical, business-relevant usage examples
+        - "alternatives": list of up to 3 objects with "formula" and "description"
+        
+        Return only the JSON object, nothing else.
+        
+        {self.reference_prompts[local_category]}
+        
+        Functions Matching Requested Operations:
+        {self._operation_function_snippets(local_category, local_analysis)}
         
         Requirement: "{requirement}"
-        Context: {json.dumps(context, indent=2) if context else "None"}
+        Context: {_prompt_json(context) if context else "None"}
+        Data Sample: {_prompt_json(data_sample) if data_sample else "None"}
+        """
+        
+        try:
+            response = await self._ask_ai(prompt, max_tokens=1200)
+            # Local models often wrap the object in prose or a code fence
+            bundle = decode_first(response, "{")
+            formula = bundle["formula"].strip()
+        except Exception as e:
+            logger.warning(f"Bundled formula generation failed, using step-by-step generation: {str(e)}")
+            return None
+        
+        analysis = bundle.get("analysis")
+        if not isinstance(analysis, dict):
+            analysis = local_analysis
+        category = self._determine_category(analysis)
+        complexity = self._determine_complexity(analysis, scan)
+        
+        validated_formula = self._validate_formula(formula)
+        # Only lists are taken; iterating a string would yield single characters
+        examples = bundle.get("examples")
+        examples = [str(example) for example in examples][:3] if isinstance(examples, list) else []
+        alternatives = bundle.get("alternatives")
+        alternatives = [
+            {"formula": str(alt.get("formula", "")), "description": str(alt.get("description", ""))}
+            for alt in alternatives
+            if isinstance(alt, dict)
+        ][:3] if isinstance(alternatives, list) else []
+        
+        return FormulaResult(
+            formula=validated_formula,
+            explanation=str(bundle.get("explanation") or
+                            f"This formula ({validated_formula}) performs the requested operation based on your requirement."),
+            category=category,
+            complexity=complexity,
+            examples=examples or [f"Use {validated_formula} with your data ranges"],
+            prerequisites=self._get_prerequisites(validated_formula),
+            alternatives=alternatives,
+            confidence=self._calculate_confidence(validated_formula, requirement, analysis)
+        )
+    
+    async def _analyze_requirement(self,
+                                   requirement: str,
+                                   scan: RequirementScan,
+                                   context: Optional[Dict] = None) -> Dict:
+        """Analyze natural language requirement to understand intent"""
+        prompt = f"""
+        Analyze the Excel formula requirement below and extract key information:
         
         Extract:
         1. Main operation (sum, lookup, count, etc.)
@@ -217,80 +625,70 @@ class FormulaGenerator:
         7. Complexity indicators
         
         Return as JSON.
+        
+        Requirement: "{requirement}"
+        Context: {_prompt_json(context) if context else "None"}
         """
         
         try:
-            response = await self.ai_service.generate_response(prompt, max_tokens=500)
-            return json.loads(response)
+            response = await self._ask_ai(prompt, max_tokens=500)
+            return orjson.loads(response)
         except Exception as e:
             logger.warning(f"Could not analyze requirement with AI: {str(e)}")
+            _note_ai_fallback("requirement analysis")
             # Fallback to basic keyword analysis
-            return self._basic_requirement_analysis(requirement)
+            return scan.analysis
     
-    def _basic_requirement_analysis(self, requirement: str) -> Dict:
-        """Basic keyword-based requirement analysis"""
+    def _analyze_local(self, requirement: str) -> RequirementScan:
+        """Keyword-based requirement analysis plus complexity signals, from one lowercased copy"""
         requirement_lower = requirement.lower()
+        keywords = _RE_WORDS.findall(requirement_lower)
+        tokens = frozenset(keywords)
         
         operations = []
-        if any(word in requirement_lower for word in ['sum', 'add', 'total']):
+        if tokens & _SUM_WORDS:
             operations.append('sum')
-        if any(word in requirement_lower for word in ['count', 'number of']):
+        if tokens & _COUNT_WORDS or 'number of' in requirement_lower:
             operations.append('count')
-        if any(word in requirement_lower for word in ['lookup', 'find', 'search']):
+        if tokens & _LOOKUP_WORDS or 'look up' in requirement_lower:
             operations.append('lookup')
-        if any(word in requirement_lower for word in ['average', 'mean']):
+        if tokens & _AVERAGE_WORDS:
             operations.append('average')
-        if any(word in requirement_lower for word in ['if', 'condition', 'when']):
+        if tokens & _CONDITIONAL_WORDS:
             operations.append('conditional')
         
-        return {
+        # Array operations and complex functions raise complexity whatever the analysis says
+        keyword_score = 0
+        if any(term in requirement_lower for term in _ARRAY_TERMS):
+            keyword_score += 2
+        if any(term in requirement_lower for term in _COMPLEX_FUNCTION_TERMS):
+            keyword_score += 1
+        
+        analysis = {
             "main_operation": operations[0] if operations else "unknown",
             "operations": operations,
             "complexity": "simple" if len(operations) <= 1 else "moderate",
-            "keywords": re.findall(r'\b\w+\b', requirement_lower),
-            "has_conditions": any(word in requirement_lower for word in ['if', 'when', 'where', 'condition']),
-            "has_ranges": bool(re.search(r'[A-Z]\d+:[A-Z]\d+|[A-Z]:[A-Z]', requirement))
+            "keywords": keywords,
+            "has_conditions": bool(tokens & _CONDITION_WORDS),
+            "has_ranges": bool(_RE_RANGE_IN_REQ.search(requirement))
         }
+        return RequirementScan(
+            analysis=analysis,
+            mentions_nesting=any(term in requirement_lower for term in _NESTING_TERMS),
+            keyword_score=keyword_score
+        )
     
-    def _determine_category(self, requirement: str, analysis: Dict) -> FormulaCategory:
+    def _determine_category(self, analysis: Dict) -> FormulaCategory:
         """Determine formula category based on requirement"""
-        main_op = analysis.get("main_operation", "").lower()
-        
-        category_mapping = {
-            "sum": FormulaCategory.MATH,
-            "count": FormulaCategory.STATISTICAL,
-            "average": FormulaCategory.STATISTICAL,
-            "lookup": FormulaCategory.LOOKUP,
-            "conditional": FormulaCategory.LOGICAL,
-            "text": FormulaCategory.TEXT,
-            "date": FormulaCategory.DATE,
-            "financial": FormulaCategory.FINANCIAL
-        }
-        
-        return category_mapping.get(main_op, FormulaCategory.CUSTOM)
+        return _CATEGORY_BY_OPERATION.get(analysis.get("main_operation", "").lower(), FormulaCategory.CUSTOM)
     
-    def _determine_complexity(self, requirement: str, analysis: Dict) -> FormulaComplexity:
+    def _determine_complexity(self, analysis: Dict, scan: RequirementScan) -> FormulaComplexity:
         """Determine formula complexity"""
-        complexity_score = 0
-        
-        # Check for multiple operations
-        operations = analysis.get("operations", [])
-        complexity_score += len(operations)
-        
-        # Check for nested conditions
-        if analysis.get("has_conditions") and any(word in requirement.lower() 
-                                                for word in ['nested', 'multiple', 'several']):
-            complexity_score += 2
-        
-        # Check for array operations
-        if any(word in requirement.lower() for word in ['unique', 'sort', 'filter', 'array']):
+        # Multiple operations, nested conditions and requirement keywords
+        complexity_score = len(analysis.get("operations", [])) + scan.keyword_score
+        if analysis.get("has_conditions") and scan.mentions_nesting:
             complexity_score += 2
         
-        # Check for complex functions
-        complex_functions = ['vlookup', 'index', 'match', 'indirect', 'offset']
-        if any(func in requirement.lower() for func in complex_functions):
-            complexity_score += 1
-        
         if complexity_score <= 1:
             return FormulaComplexity.SIMPLE
         elif complexity_score <= 3:
@@ -308,25 +706,10 @@ class FormulaGenerator:
                                  data_sample: Optional[Dict] = None) -> str:
         """Generate formula using AI with context"""
         
-        # Get relevant function library entries
-        relevant_functions = self._get_relevant_functions(category, analysis)
-        
         prompt = f"""
-        Generate an Excel formula for this requirement:
+        Generate an Excel formula for the requirement below.
         
-        Requirement: "{requirement}"
-        Category: {category.value}
-        Complexity: {complexity.value}
-        Analysis: {json.dumps(analysis, indent=2)}
-        Data Sample: {json.dumps(data_sample, indent=2) if data_sample else "None"}
-        
-        Relevant Excel Functions:
-        {json.dumps(relevant_functions, indent=2)}
-        
-        Formula Patterns:
-        {json.dumps(self._get_relevant_patterns(category), indent=2)}
-        
-        Requirements:
+        Rules:
         1. Generate a valid Excel formula starting with =
         2. Use proper Excel function syntax
         3. Include cell references and ranges as needed
@@ -335,10 +718,21 @@ class FormulaGenerator:
         6. Make it as simple as possible while meeting requirements
         
         Return only the Excel formula, nothing else.
+        
+        {self.reference_prompts[category]}
+        
+        Functions Matching Requested Operations:
+        {self._operation_function_snippets(category, analysis)}
+        
+        Category: {category.value}
+        Complexity: {complexity.value}
+        Requirement: "{requirement}"
+        Analysis: {_prompt_json(analysis)}
+        Data Sample: {_prompt_json(data_sample) if data_sample else "None"}
         """
         
         try:
-            formula = await self.ai_service.generate_response(prompt, max_tokens=300)
+            formula = await self._ask_ai(prompt, max_tokens=300)
             formula = formula.strip()
             
             # Ensure formula starts with =
@@ -348,22 +742,57 @@ class FormulaGenerator:
             return formula
         except Exception as e:
             logger.error(f"AI formula generation failed: {str(e)}")
+            _note_ai_fallback("formula")
             # Fallback to pattern-based generation
             return self._generate_formula_pattern(requirement, analysis, category)
     
     def _get_relevant_functions(self, category: FormulaCategory, analysis: Dict) -> Dict:
         """Get relevant Excel functions for the category"""
-        relevant = {}
-        operations = analysis.get("operations", [])
-        
-        for func_name, func_info in self.function_library.items():
-            if func_info["category"] == category:
-                relevant[func_name] = func_info
-            elif any(op in func_name.lower() for op in operations):
-                relevant[func_name] = func_info
-                
+        relevant = dict(self.functions_by_category.get(category.value, {}))
+        relevant.update(self._get_operation_functions(category, analysis))
         return relevant
     
+    def _get_operation_functions(self, category: FormulaCategory, analysis: Dict) -> Dict:
+        """Get functions matching the requested operations from outside the category"""
+        category_functions = self.functions_by_category.get(category.value, {})
+        matched = {}
+        
+        for op in analysis.get("operations", []):
+            matches = self.functions_by_operation.get(op)
+            if matches is None:
+                # Operations outside the index come from free-form AI analysis
+                matches = [name for name in self.function_library if op in name.lower()]
+            for func_name in matches:
+                if func_name not in category_functions:
+                    matched[func_name] = self.function_library[func_name]
+                
+        return matched
+    
+    def _index_function_snippets(self) -> Dict[str, str]:
+        """One prompt line per function: its syntax and first example"""
+        return {
+            name: f"{info['syntax']} e.g. {info['examples'][0]}"
+            for name, info in self.function_library.items()
+        }
+    
+    def _index_reference_prompts(self) -> Dict[FormulaCategory, str]:
+        """Build each category's function and pattern reference once for prompt reuse"""
+        return {
+            category: (
+                "Relevant Excel Functions:\n"
+                + ("\n".join(self.function_snippets[name]
+                             for name in self.functions_by_category.get(category.value, {})) or "None")
+                + "\n\nFormula Patterns:\n"
+                + _prompt_json(self._get_relevant_patterns(category))
+            )
+            for category in FormulaCategory
+        }
+    
+    def _operation_function_snippets(self, category: FormulaCategory, analysis: Dict) -> str:
+        """Render the request-specific extra functions for the prompt tail"""
+        matched = self._get_operation_functions(category, analysis)
+        return "\n".join(self.function_snippets[name] for name in matched) or "None"
+    
     def _get_relevant_patterns(self, category: FormulaCategory) -> Dict:
         """Get relevant formula patterns for the category"""
         pattern_mapping = {
@@ -395,35 +824,79 @@ class FormulaGenerator:
         else:
             return "=A1"
     
-    async def _validate_formula(self, formula: str) -> str:
+    def _validate_formula(self, formula: str) -> str:
         """Validate and clean up formula"""
         # Basic validation
         if not formula.startswith('='):
             formula = '=' + formula
             
+        tokens = _tokenize_formula(formula)
+        
         # Check for balanced parentheses
-        if formula.count('(') != formula.count(')'):
+        if not tokens.parentheses_balanced:
             logger.warning("Formula has unbalanced parentheses")
             
         # Check for valid function names
-        functions = re.findall(r'[A-Z]+(?=\()', formula)
-        invalid_functions = [f for f in functions if f not in self.function_library and f not in [
-            'XLOOKUP', 'XMATCH', 'UNIQUE', 'SORT', 'FILTER', 'SEQUENCE', 'RANDARRAY'
-        ]]
+        invalid_functions = [f for f in tokens.functions if f not in self.known_functions]
         
         if invalid_functions:
             logger.warning(f"Formula contains potentially invalid functions: {invalid_functions}")
         
         return formula
     
+    def validate_formulas_batch(self, formulas: List[str]) -> List[Dict[str, Any]]:
+        """
+        Validate many formulas in one pass for bulk workbook scans.
+        
+        Identical formulas are checked once. Parenthesis balance for every
+        distinct formula comes from vectorized running sums over the joined
+        text, and function names from a single regex pass over it.
+        """
+        normalized = [f if f.startswith('=') else '=' + f for f in formulas]
+        unique = list(dict.fromkeys(normalized))
+        if not unique:
+            return []
+        
+        # Formulas are NUL-separated so each segment is at least one character
+        joined = "\0".join(unique) + "\0"
+        codes = np.frombuffer(joined.encode("utf-32-le"), dtype=np.uint32)
+        lengths = np.fromiter((len(f) + 1 for f in unique), dtype=np.int64, count=len(unique))
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        
+        # Quote parity within each formula marks characters inside string literals
+        is_quote = (codes == ord('"')).astype(np.int64)
+        quotes_seen = np.cumsum(is_quote)
+        quotes_before = quotes_seen[starts] - is_quote[starts]
+        in_string = ((quotes_seen - np.repeat(quotes_before, lengths)) & 1).astype(bool)
+        
+        delta = ((codes == ord('(')) & ~in_string).astype(np.int64) - ((codes == ord(')')) & ~in_string)
+        depth = np.cumsum(delta)
+        depth_before = depth[starts] - delta[starts]
+        final_depth = np.add.reduceat(delta, starts)
+        lowest_depth = np.minimum.reduceat(depth, starts) - depth_before
+        balanced = (final_depth == 0) & (lowest_depth >= 0)
+        
+        invalid: List[List[str]] = [[] for _ in unique]
+        matches = [(m.start(), m.group()) for m in _RE_FUNCS.finditer(joined) if m.group() not in self.known_functions]
+        if matches:
+            owners = np.searchsorted(starts, [position for position, _ in matches], side="right") - 1
+            for owner, (_, name) in zip(owners.tolist(), matches):
+                invalid[owner].append(name)
+        
+        results = {
+            formula: {
+                "formula": formula,
+                "parentheses_balanced": bool(is_balanced),
+                "invalid_functions": names
+            }
+            for formula, is_balanced, names in zip(unique, balanced.tolist(), invalid)
+        }
+        return [results[formula] for formula in normalized]
+    
     async def _generate_explanation(self, formula: str, requirement: str, analysis: Dict) -> str:
         """Generate human-readable explanation of the formula"""
         prompt = f"""
-        Explain this Excel formula in simple, clear terms:
-        
-        Formula: {formula}
-        Original Requirement: "{requirement}"
-        Analysis: {json.dumps(analysis, indent=2)}
+        Explain the Excel formula below in simple, clear terms.
         
         Provide:
         1. What the formula does in plain English
@@ -432,21 +905,23 @@ class FormulaGenerator:
         4. When to use this approach
         
         Keep it concise but comprehensive.
+        
+        Formula: {formula}
+        Original Requirement: "{requirement}"
+        Analysis: {_prompt_json(analysis)}
         """
         
         try:
-            return await self.ai_service.generate_response(prompt, max_tokens=400)
+            return await self._ask_ai(prompt, max_tokens=400)
         except Exception as e:
             logger.warning(f"Could not generate explanation: {str(e)}")
+            _note_ai_fallback("explanation")
             return f"This formula ({formula}) performs the requested operation based on your requirement."
     
     async def _generate_examples(self, formula: str, context: Optional[Dict] = None) -> List[str]:
         """Generate example uses of the formula"""
         prompt = f"""
-        Generate 3 practical examples of how to use this Excel formula:
-        
-        Formula: {formula}
-        Context: {json.dumps(context, indent=2) if context else "General business data"}
+        Generate 3 practical examples of how to use the Excel formula below.
         
         For each example, provide:
         - Sample data scenario
@@ -454,25 +929,25 @@ class FormulaGenerator:
         - Expected result
         
         Keep examples realistic and business-relevant.
+        
+        Formula: {formula}
+        Context: {_prompt_json(context) if context else "General business data"}
         """
         
         try:
-            response = await self.ai_service.generate_response(prompt, max_tokens=300)
+            response = await self._ask_ai(prompt, max_tokens=300)
             # Parse response into list (simplified)
             examples = [line.strip() for line in response.split('\n') if line.strip() and not line.startswith('Example')]
             return examples[:3]  # Limit to 3 examples
         except Exception as e:
             logger.warning(f"Could not generate examples: {str(e)}")
+            _note_ai_fallback("examples")
             return [f"Use {formula} with your data ranges"]
     
     async def _find_alternatives(self, formula: str, requirement: str, category: FormulaCategory) -> List[Dict[str, str]]:
         """Find alternative formulas that achieve the same result"""
         prompt = f"""
-        Suggest 2-3 alternative Excel formulas for this requirement:
-        
-        Current Formula: {formula}
-        Requirement: "{requirement}"
-        Category: {category.value}
+        Suggest 2-3 alternative Excel formulas for the requirement below.
         
         For each alternative, provide:
         - The alternative formula
@@ -480,14 +955,18 @@ class FormulaGenerator:
         - When to use it instead
         
         Focus on different approaches or newer Excel functions.
+        
+        Category: {category.value}
+        Requirement: "{requirement}"
+        Current Formula: {formula}
         """
         
         try:
-            response = await self.ai_service.generate_response(prompt, max_tokens=400)
+            response = await self._ask_ai(prompt, max_tokens=400)
             # Parse response into alternatives (simplified)
-            alternatives = []
+            alternatives: List[Dict[str, str]] = []
             lines = response.split('\n')
-            current_alt = {}
+            current_alt: Dict[str, str] = {}
             
             for line in lines:
                 line = line.strip()
@@ -504,29 +983,15 @@ class FormulaGenerator:
             return alternatives[:3]  # Limit to 3 alternatives
         except Exception as e:
             logger.warning(f"Could not find alternatives: {str(e)}")
+            _note_ai_fallback("alternatives")
             return []
     
-    def _get_prerequisites(self, formula: str) -> List[str]:
+    @staticmethod
+    def _get_prerequisites(formula: str) -> List[str]:
         """Get prerequisites for using the formula"""
-        prerequisites = []
-        
-        # Check for advanced functions
-        if 'XLOOKUP' in formula:
-            prerequisites.append("Excel 365 or Excel 2021")
-        if any(func in formula for func in ['UNIQUE', 'SORT', 'FILTER']):
-            prerequisites.append("Excel 365 with dynamic arrays")
-        if 'LAMBDA' in formula:
-            prerequisites.append("Excel 365 with LAMBDA function support")
-        
-        # Check for complex features
-        if '[]' in formula:
-            prerequisites.append("Dynamic array formulas enabled")
-        if 'INDIRECT' in formula:
-            prerequisites.append("Be cautious with file links and references")
-        
-        return prerequisites
+        return list(_formula_prerequisites(formula))
     
-    async def _calculate_confidence(self, formula: str, requirement: str, analysis: Dict) -> float:
+    def _calculate_confidence(self, formula: str, requirement: str, analysis: Dict) -> float:
         """Calculate confidence score for the generated formula"""
         confidence = 0.8  # Base confidence
         
@@ -539,102 +1004,425 @@ class FormulaGenerator:
             confidence += 0.1
         
         # Adjust based on recognized functions
-        functions = re.findall(r'[A-Z]+(?=\()', formula)
+        functions = _RE_FUNCS.findall(formula)
         if all(func in self.function_library for func in functions):
             confidence += 0.1
         
         # Cap at 1.0
         return min(confidence, 1.0)
 
+# Common Excel error patterns and solutions; static, so shared by all debuggers
+_ERROR_PATTERNS = {
+    "#DIV/0!": {
+        "description": "Division by zero error",
+        "common_causes": [
+            "Dividing by a cell containing zero",
+            "Dividing by an empty cell",
+            "Result of another formula is zero"
+        ],
+        "solutions": [
+            "Use IF statement to check for zero: =IF(B1=0, \"\", A1/B1)",
+            "Use IFERROR: =IFERROR(A1/B1, \"Error\")",
+            "Check data source for zero values"
+        ]
+    },
+    "#VALUE!": {
+        "description": "Wrong data type error",
+        "common_causes": [
+            "Text used in mathematical operations",
+            "Incompatible data types",
+            "Invalid date/time values"
+        ],
+        "solutions": [
+            "Use VALUE() to convert text to numbers",
+            "Check data formatting",
+            "Use ISNUMBER() to validate data"
+        ]
+    },
+    "#REF!": {
+        "description": "Invalid cell reference",
+        "common_causes": [
+            "Referenced cells were deleted",
+            "Invalid range references",
+            "Circular references"
+        ],
+        "solutions": [
+            "Check and update cell references",
+            "Restore deleted cells",
+            "Use INDIRECT for dynamic references"
+        ]
+    },
+    "#NAME?": {
+        "description": "Unrecognized function or name",
+        "common_causes": [
+            "Misspelled function name",
+            "Missing quotes around text",
+            "Undefined named range"
+        ],
+        "solutions": [
+            "Check function spelling",
+            "Add quotes around text values",
+            "Define or fix named ranges"
+        ]
+    },
+    "#N/A": {
+        "description": "Value not available",
+        "common_causes": [
+            "VLOOKUP/MATCH value not found",
+            "Array size mismatch",
+            "Missing data"
+        ],
+        "solutions": [
+            "Use IFERROR with lookup functions",
+            "Check lookup values exist",
+            "Use approximate match if appropriate"
+        ]
+    },
+    "#NULL!": {
+        "description": "Null intersection error",
+        "common_causes": [
+            "Incorrect range operator",
+            "Missing comma or colon in range",
+            "Space instead of comma"
+        ],
+        "solutions": [
+            "Check range operators (: vs space)",
+            "Verify comma placement",
+            "Use proper range syntax"
+        ]
+    }
+}
+
+def _column_number(letters: str) -> int:
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - 64
+    return number
+
+def _scan_references(formula: str) -> ReferenceScan:
+    """
+    Collect a formula's position-independent shape and reference slots in one pass.
+    
+    The shape maps each cell reference to a token: relative rows and columns
+    become offsets from the first relative row and column in the formula,
+    absolute parts stay literal. Formulas filled down or across from one
+    another therefore get identical tokens, e.g. =A1/B1 and =A2/B2 both map
+    to offsets (0, 0) and (1, 0). It is empty when the formula has no
+    relative references.
+    
+    The structure replaces each distinct reference with a numbered slot in
+    order of first use, so =A1/B1 and =C5/D9 share the structure of =<0>/<1>
+    while =A1/A1 does not; cells lists the references in slot order.
+    """
+    slots: Dict[str, str] = {}
+    parts = []
+    copied = 0
+    anchor_column: Optional[int] = None
+    anchor_row: Optional[int] = None
+    found = []
+    
+    for m in _RE_FORMULA_CELL_REF.finditer(formula):
+        column_absolute, column, row_absolute, row = m.groups()
+        if not column:
+            continue
+        reference = m.group()
+        parts.append(formula[copied:m.start()])
+        parts.append(slots.setdefault(reference, f'\0{len(slots)}\0'))
+        copied = m.end()
+        
+        column_number = _column_number(column)
+        if anchor_column is None and not column_absolute:
+            anchor_column = column_number
+        if anchor_row is None and not row_absolute:
+            anchor_row = int(row)
+        found.append((reference, column_absolute, column, column_number, row_absolute, row))
+    parts.append(formula[copied:])
+    
+    shape = {}
+    if anchor_column is not None or anchor_row is not None:
+        for reference, column_absolute, column, column_number, row_absolute, row in found:
+            column_part = '$' + column if column_absolute else f'c{column_number - (anchor_column or 0)}'
+            row_part = '$' + row if row_absolute else f'r{int(row) - (anchor_row or 0)}'
+            shape[reference] = f'\0{column_part}{row_part}\0'
+    
+    return ReferenceScan(shape=shape, structure=''.join(parts), cells=list(slots))
+
+def _map_strings(value: Any, transform: Callable[[str], str]) -> Any:
+    """Apply transform to every string inside a parsed JSON value"""
+    if isinstance(value, str):
+        return transform(value)
+    if isinstance(value, list):
+        return [_map_strings(item, transform) for item in value]
+    if isinstance(value, dict):
+        return {key: _map_strings(item, transform) for key, item in value.items()}
+    return value
+
+def _replace_references(value: Any, replacements: Dict[str, str]) -> Any:
+    """Rewrite known cell references in every string of a parsed JSON value"""
+    return _map_strings(value, lambda text: _RE_CELL_REF.sub(lambda m: replacements.get(m.group(), m.group()), text))
+
+def _fill_reference_slots(value: Any, references: List[str]) -> Any:
+    """Put a formula's references into the numbered slots of a solution template"""
+    return _map_strings(value, lambda text: _RE_REFERENCE_SLOT.sub(lambda m: references[int(m.group(1))], text))
+
+# Structure analysis fields each debugger prompt needs; references and
+# operators are left out since the formula itself is in every prompt
+_ANALYSIS_FIELDS = {
+    "errors": ("functions", "range_references", "parentheses_balanced", "has_nested_functions",
+               "has_conditions", "has_lookups", "has_arrays"),
+    "solution": ("functions", "parentheses_balanced", "has_lookups"),
+    "optimizations": ("functions", "range_references", "complexity_score", "has_nested_functions",
+                      "has_lookups", "has_arrays")
+}
+
+def _project_analysis(endpoint: str, analysis: Dict) -> Dict:
+    """Keep only the analysis fields relevant to one kind of AI request"""
+    return {field: analysis[field] for field in _ANALYSIS_FIELDS[endpoint] if field in analysis}
+
+# Debugger prompt templates; only the per-request values are substituted per call
+_ERROR_SECTION_TEMPLATE = """
+        Formula: {formula}
+        Structure Analysis: {analysis}
+        Cell Data: {cell_data}
+        """
+
+_ERROR_DETECTION_TEMPLATE = """
+        Analyze {subject} for potential errors and issues:
+        {formulas}
+        Common Excel Error Types:
+        {error_types}
+        
+        Look for:
+        1. Syntax errors
+        2. Logic errors
+        3. Performance issues
+        4. Data type mismatches
+        5. Reference errors
+        6. Edge cases
+        
+        {output}
+        """
+
+_ERROR_DETECTION_OUTPUT = (
+    "Return findings as JSON array with error_type, description, suggestion, severity.\n"
+    "        Respond with ONLY the JSON array, no prose."
+)
+
+_ERROR_DETECTION_BATCH_OUTPUT = (
+    "Return a JSON array with one entry per formula, in the order given. "
+    "Each entry is a JSON array of findings with error_type, description, suggestion, severity.\n"
+    "        Respond with ONLY the JSON array, no prose."
+)
+
+_SOLUTION_PROMPT_TEMPLATE = """
+        Fix this Excel formula error:
+        
+        Original Formula: {formula}
+        Error: {error_type} - {description}
+        Suggestion: {suggestion}
+        Analysis: {analysis}
+        
+        Provide:
+        1. Corrected formula
+        2. Explanation of changes made
+        3. Why this solution works
+        
+        Return as JSON with formula, description, changes, confidence fields.
+        Respond with ONLY the JSON object, no prose.
+        """
+
+_OPTIMIZATION_PROMPT_TEMPLATE = """
+        Suggest optimizations for this Excel formula:
+        
+        Formula: {formula}
+        Analysis: {analysis}
+        
+        Look for:
+        1. Performance improvements
+        2. Modern function alternatives
+        3. Simplification opportunities
+        4. Better error handling
+        5. Readability improvements
+        
+        Return as JSON array with type, description, suggestion fields.
+        Respond with ONLY the JSON array, no prose.
+        """
+
+def _wrap_divisions(formula: str) -> str:
+    """Wrap division operations with IFERROR; formulas without one are returned as-is"""
+    return _RE_DIVISION.sub(r'IFERROR(\1/\2, "")', formula)
+
+def _wrap_lookups(formula: str) -> str:
+    """Wrap lookup functions with IFERROR"""
+    if 'VLOOKUP' not in _function_triggers(formula):
+        return formula
+
+    # Walk each call to its matching paren so nested calls and quoted
+    # parens stay inside the wrapped slice
+    parts = []
+    copied = 0
+    start = formula.find('VLOOKUP(')
+    while start >= 0:
+        if start and (formula[start - 1].isalnum() or formula[start - 1] in '_.'):
+            start = formula.find('VLOOKUP(', start + 1)
+            continue
+
+        depth = 0
+        in_string = False
+        end = -1
+        for index in range(start + 7, len(formula)):
+            char = formula[index]
+            if char == '"':
+                in_string = not in_string
+            elif in_string:
+                continue
+            elif char == '(':
+                depth += 1
+            elif char == ')':
+                depth -= 1
+                if depth == 0:
+                    end = index + 1
+                    break
+        if end < 0:
+            break
+
+        parts.append(formula[copied:start])
+        parts.append(f'IFERROR({formula[start:end]}, "Not Found")')
+        copied = end
+        start = formula.find('VLOOKUP(', end)
+
+    parts.append(formula[copied:])
+    return ''.join(parts)
+
+_HIGH_COMPLEXITY_OPTIMIZATION = {
+    "type": "performance",
+    "description": "Formula complexity is high, consider breaking into multiple cells",
+    "suggestion": "Split complex operations into intermediate calculations"
+}
+_XLOOKUP_OPTIMIZATION = {
+    "type": "modern_alternative",
+    "description": "Consider using XLOOKUP instead of VLOOKUP for better performance",
+    "suggestion": "Replace VLOOKUP with XLOOKUP if using Excel 365"
+}
+
+@lru_cache(maxsize=FORMULA_ANALYSIS_CACHE_SIZE)
+def _suggest_optimizations_local(complexity_score: int, has_vlookup: bool) -> Tuple[Dict[str, str], ...]:
+    """Rule-based optimization suggestions; the shared dicts must not be mutated"""
+    optimizations = []
+    
+    # Check for performance improvements
+    if complexity_score > 5:
+        optimizations.append(_HIGH_COMPLEXITY_OPTIMIZATION)
+    
+    # Check for newer function alternatives
+    if has_vlookup:
+        optimizations.append(_XLOOKUP_OPTIMIZATION)
+    
+    return tuple(optimizations)
+
+# Local formula rewrites for error types that have one, built from the precompiled patterns
+_SOLUTION_FIXERS: Dict[str, Callable[[str], str]] = {
+    "#DIV/0!": _wrap_divisions,
+    "#N/A": _wrap_lookups
+}
+
+# Function names the debugger accepts, sorted for prefix lookups
+_KNOWN_FUNCTIONS = frozenset(_FUNCTION_LIBRARY) | _MODERN_FUNCTIONS | {'COUNT'}
+_KNOWN_FUNCTION_NAMES = tuple(sorted(_KNOWN_FUNCTIONS))
+
+def _suggest_function_names(name: str, limit: int = 3) -> List[str]:
+    """Suggest known function names sharing a prefix with, or resembling, an unknown one"""
+    prefix = name[:3]
+    suggestions: List[str] = []
+    for candidate in _KNOWN_FUNCTION_NAMES[bisect_left(_KNOWN_FUNCTION_NAMES, prefix):]:
+        if not candidate.startswith(prefix) or len(suggestions) == limit:
+            break
+        suggestions.append(candidate)
+    return suggestions or difflib.get_close_matches(name, _KNOWN_FUNCTION_NAMES, n=limit)
+
 class FormulaDebugger:
     """AI-powered Excel formula debugging system"""
     
-    def __init__(self, ai_service):
+    def __init__(self, ai_service: Any) -> None:
         self.ai_service = ai_service
         self.error_patterns = self._load_error_patterns()
+        # Error code -> (description, first solution) for the identification hot path
+        self._error_suggestion: Dict[str, Tuple[str, str]] = {
+            code: (info["description"], info["solutions"][0])
+            for code, info in self.error_patterns.items()
+        }
+        self._error_types_json = _prompt_json(list(self.error_patterns))
+        # Parsed AI answers keyed by the exact prompt; concurrent duplicates share one call
+        self._ai_cache = ResponseCache(
+            max_size=server_config.ai_response_cache_size, ttl=server_config.response_cache_ttl
+        )
+        self._ai_inflight = SingleFlight()
+        # Second tier keyed by the prompt with the formula's references made
+        # position-independent, so filled-down copies reuse one answer
+        self._ai_shape_cache = ResponseCache(
+            max_size=server_config.ai_response_cache_size, ttl=server_config.response_cache_ttl
+        )
+        # AI fixes generalized over their references, keyed by error type and formula structure
+        self._solution_templates = ResponseCache(
+            max_size=server_config.ai_response_cache_size, ttl=server_config.response_cache_ttl
+        )
+        # AI findings already returned; the same finding reported for another formula reuses the instance
+        self._interned_errors: Dict[FormulaError, FormulaError] = {}
+        self._error_detection_batcher = MicroBatcher(
+            self._detect_errors_batch,
+            # Every formula in a batch keeps its full share of the reply
+            max_size=max(1, min(ERROR_DETECTION_BATCH_SIZE, server_config.ai_batch_max_tokens // ERROR_DETECTION_MAX_TOKENS)),
+            max_delay=ERROR_DETECTION_BATCH_DELAY
+        )
         
     def _load_error_patterns(self) -> Dict:
         """Load common Excel error patterns and solutions"""
-        return {
-            "#DIV/0!": {
-                "description": "Division by zero error",
-                "common_causes": [
-                    "Dividing by a cell containing zero",
-                    "Dividing by an empty cell",
-                    "Result of another formula is zero"
-                ],
-                "solutions": [
-                    "Use IF statement to check for zero: =IF(B1=0, \"\", A1/B1)",
-                    "Use IFERROR: =IFERROR(A1/B1, \"Error\")",
-                    "Check data source for zero values"
-                ]
-            },
-            "#VALUE!": {
-                "description": "Wrong data type error",
-                "common_causes": [
-                    "Text used in mathematical operations",
-                    "Incompatible data types",
-                    "Invalid date/time values"
-                ],
-                "solutions": [
-                    "Use VALUE() to convert text to numbers",
-                    "Check data formatting",
-                    "Use ISNUMBER() to validate data"
-                ]
-            },
-            "#REF!": {
-                "description": "Invalid cell reference",
-                "common_causes": [
-                    "Referenced cells were deleted",
-                    "Invalid range references",
-                    "Circular references"
-                ],
-                "solutions": [
-                    "Check and update cell references",
-                    "Restore deleted cells",
-                    "Use INDIRECT for dynamic references"
-                ]
-            },
-            "#NAME?": {
-                "description": "Unrecognized function or name",
-                "common_causes": [
-                    "Misspelled function name",
-                    "Missing quotes around text",
-                    "Undefined named range"
-                ],
-                "solutions": [
-                    "Check function spelling",
-                    "Add quotes around text values",
-                    "Define or fix named ranges"
-                ]
-            },
-            "#N/A": {
-                "description": "Value not available",
-                "common_causes": [
-                    "VLOOKUP/MATCH value not found",
-                    "Array size mismatch",
-                    "Missing data"
-                ],
-                "solutions": [
-                    "Use IFERROR with lookup functions",
-                    "Check lookup values exist",
-                    "Use approximate match if appropriate"
-                ]
-            },
-            "#NULL!": {
-                "description": "Null intersection error",
-                "common_causes": [
-                    "Incorrect range operator",
-                    "Missing comma or colon in range",
-                    "Space instead of comma"
-                ],
-                "solutions": [
-                    "Check range operators (: vs space)",
-                    "Verify comma placement",
-                    "Use proper range syntax"
-                ]
-            }
-        }
+        return _ERROR_PATTERNS
+    
+    async def _ask_ai_json(self,
+                           prompt: str,
+                           max_tokens: int,
+                           shape: Optional[Dict[str, str]] = None,
+                           fetch: Optional[Callable[[], Awaitable[Any]]] = None,
+                           opening: str = "[") -> Any:
+        """
+        Query the AI service for JSON, reusing the parsed answer for a prompt already asked.
+        
+        When the reference shape of the formula the prompt is about is given,
+        an answer for a copy of it shifted to other cells is reused too, with
+        its references translated.
+        On a miss, fetch produces the answer if given; otherwise the prompt is
+        sent as-is and the first JSON value starting with opening is decoded.
+        """
+        cache_key = ResponseCache.make_key(prompt, max_tokens)
+        cached = self._ai_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        if shape:
+            shape_key = ResponseCache.make_key(_replace_references(prompt, shape), max_tokens)
+            shifted = self._ai_shape_cache.get(shape_key)
+            if shifted is not None:
+                source_shape, source_parsed = shifted
+                references_by_token = {token: reference for reference, token in shape.items()}
+                parsed = _replace_references(source_parsed, {
+                    reference: references_by_token[token] for reference, token in source_shape.items()
+                })
+                self._ai_cache.set(cache_key, parsed)
+                return parsed
+        
+        parsed = await self._ai_inflight.run(cache_key, fetch or (lambda: self._fetch_ai_json(prompt, max_tokens, opening)))
+        self._ai_cache.set(cache_key, parsed)
+        if shape:
+            self._ai_shape_cache.set(shape_key, (shape, parsed))
+        return parsed
+    
+    async def _fetch_ai_json(self, prompt: str, max_tokens: int, opening: str = "[") -> Any:
+        response = await self.ai_service.generate_response(prompt, max_tokens=max_tokens)
+        # Tolerate prose or code fences around the JSON the prompt asked for
+        if len(response) >= AI_JSON_OFFLOAD_CHARS:
+            return await asyncio.get_event_loop().run_in_executor(None, decode_first, response, opening)
+        return decode_first(response, opening)
     
     async def debug_formula(self, 
                           formula: str, 
@@ -643,16 +1431,12 @@ class FormulaDebugger:
         """Debug Excel formula and provide solutions"""
         try:
             # Analyze the formula
-            analysis = await self._analyze_formula_structure(formula)
-            
-            # Identify errors
-            errors = await self._identify_errors(formula, error_message, analysis, cell_data)
-            
-            # Generate solutions
-            solutions = await self._generate_solutions(formula, errors, analysis)
+            analysis = self._analyze_formula_structure(formula)
             
-            # Provide optimizations
-            optimizations = await self._suggest_optimizations(formula, analysis)
+            # Identify errors, solve them and suggest optimizations
+            errors, solutions, optimizations = await self._analyze_formula_fused(
+                formula, analysis, error_message, cell_data
+            )
             
             return {
                 "formula": formula,
@@ -667,42 +1451,54 @@ class FormulaDebugger:
             logger.error(f"Error debugging formula: {str(e)}")
             raise
     
-    async def _analyze_formula_structure(self, formula: str) -> Dict:
-        """Analyze formula structure and components"""
-        analysis = {
-            "functions": re.findall(r'[A-Z]+(?=\()', formula),
-            "cell_references": re.findall(r'[A-Z]+\d+', formula),
-            "range_references": re.findall(r'[A-Z]+\d+:[A-Z]+\d+', formula),
-            "operators": re.findall(r'[+\-*/^&<>=]', formula),
-            "parentheses_count": formula.count('('),
-            "parentheses_balanced": formula.count('(') == formula.count(')'),
-            "has_nested_functions": len(re.findall(r'[A-Z]+\([^)]*[A-Z]+\(', formula)) > 0,
-            "complexity_score": len(re.findall(r'[A-Z]+(?=\()', formula)) + formula.count('(')
-        }
+    async def _analyze_formula_fused(self,
+                                   formula: str,
+                                   analysis: Dict,
+                                   error_message: Optional[str],
+                                   cell_data: Optional[Dict] = None) -> Tuple[List[FormulaError], List[Dict], List[Dict]]:
+        """
+        Produce errors, solutions and optimizations from one reference scan.
         
-        # Check for common patterns
-        analysis["has_conditions"] = bool(re.search(r'IF\s*\(', formula))
-        analysis["has_lookups"] = any(func in formula for func in ['VLOOKUP', 'HLOOKUP', 'INDEX', 'MATCH'])
-        analysis["has_arrays"] = bool(re.search(r'\{.*\}', formula))
+        The scan is shared by every AI request and solution template lookup
+        for the formula. Optimizations do not depend on the errors found, so
+        they are worked out alongside error detection and solving.
+        """
+        scan = _scan_references(formula)
+        
+        async def errors_and_solutions() -> Tuple[List[FormulaError], List[Dict]]:
+            errors = await self._identify_errors(formula, error_message, analysis, cell_data, scan)
+            return errors, await self._generate_solutions(formula, errors, analysis, scan)
         
-        return analysis
+        (errors, solutions), optimizations = await asyncio.gather(
+            errors_and_solutions(),
+            self._suggest_optimizations(formula, analysis, scan)
+        )
+        return errors, solutions, optimizations
+    
+    @staticmethod
+    def _analyze_formula_structure(formula: str) -> Dict:
+        """Analyze formula structure and components"""
+        # Copy the memoized top level so the debug result can be extended freely
+        return dict(_formula_structure(formula))
     
     async def _identify_errors(self, 
                              formula: str, 
                              error_message: Optional[str],
                              analysis: Dict,
-                             cell_data: Optional[Dict] = None) -> List[FormulaError]:
+                             cell_data: Optional[Dict],
+                             scan: ReferenceScan) -> List[FormulaError]:
         """Identify errors in the formula"""
         errors = []
         
         # Check for known error messages
-        if error_message and error_message in self.error_patterns:
-            error_info = self.error_patterns[error_message]
+        known_error = self._error_suggestion.get(error_message) if error_message else None
+        if error_message and known_error:
+            description, suggestion = known_error
             errors.append(FormulaError(
                 error_type=error_message,
                 location=None,
-                description=error_info["description"],
-                suggestion=error_info["solutions"][0],
+                description=description,
+                suggestion=suggestion,
                 severity="high"
             ))
         
@@ -717,20 +1513,28 @@ class FormulaDebugger:
             ))
         
         # Check for invalid functions
-        invalid_functions = [f for f in analysis["functions"] 
-                           if f not in ['SUM', 'COUNT', 'AVERAGE', 'IF', 'VLOOKUP', 'INDEX', 'MATCH', 'CONCATENATE']]
+        invalid_functions = [f for f in analysis["functions"] if f not in _KNOWN_FUNCTIONS]
         if invalid_functions:
+            suggestion = "Verify function names and Excel version compatibility"
+            hints = []
+            for name in dict.fromkeys(invalid_functions):
+                candidates = _suggest_function_names(name)
+                if candidates:
+                    hints.append(f"{name}: did you mean {' or '.join(candidates)}?")
+            if hints:
+                suggestion += " (" + "; ".join(hints) + ")"
+            
             errors.append(FormulaError(
                 error_type="function",
                 location=", ".join(invalid_functions),
                 description=f"Potentially invalid or unsupported functions: {', '.join(invalid_functions)}",
-                suggestion="Verify function names and Excel version compatibility",
+                suggestion=suggestion,
                 severity="medium"
             ))
         
         # Use AI for deeper analysis
         if not errors:
-            ai_errors = await self._ai_error_detection(formula, analysis, cell_data)
+            ai_errors = await self._ai_error_detection(formula, analysis, cell_data, scan)
             errors.extend(ai_errors)
         
         return errors
@@ -738,52 +1542,92 @@ class FormulaDebugger:
     async def _ai_error_detection(self, 
                                 formula: str, 
                                 analysis: Dict,
-                                cell_data: Optional[Dict] = None) -> List[FormulaError]:
+                                cell_data: Optional[Dict],
+                                scan: ReferenceScan) -> List[FormulaError]:
         """Use AI to detect potential errors"""
-        prompt = f"""
-        Analyze this Excel formula for potential errors and issues:
-        
-        Formula: {formula}
-        Structure Analysis: {json.dumps(analysis, indent=2)}
-        Cell Data: {json.dumps(cell_data, indent=2) if cell_data else "Not available"}
-        
-        Common Excel Error Types:
-        {json.dumps(list(self.error_patterns.keys()))}
-        
-        Look for:
-        1. Syntax errors
-        2. Logic errors
-        3. Performance issues
-        4. Data type mismatches
-        5. Reference errors
-        6. Edge cases
-        
-        Return findings as JSON array with error_type, description, suggestion, severity.
-        """
+        section = _ERROR_SECTION_TEMPLATE.format(
+            formula=formula,
+            analysis=_prompt_json(_project_analysis("errors", analysis)),
+            cell_data=_prompt_json(cell_data) if cell_data else "Not available"
+        )
+        # Cached under the single-formula prompt; misses are batched with concurrent ones
+        prompt = self._error_detection_prompt([section])
         
         try:
-            response = await self.ai_service.generate_response(prompt, max_tokens=500)
-            ai_errors_data = json.loads(response)
+            ai_errors_data = await self._ask_ai_json(
+                prompt,
+                max_tokens=ERROR_DETECTION_MAX_TOKENS,
+                shape=scan.shape,
+                fetch=lambda: self._error_detection_batcher.submit(section)
+            )
             
-            errors = []
-            for error_data in ai_errors_data:
-                errors.append(FormulaError(
+            return self._intern_errors([
+                FormulaError(
                     error_type=error_data.get("error_type", "unknown"),
                     location=error_data.get("location"),
                     description=error_data.get("description", ""),
                     suggestion=error_data.get("suggestion", ""),
                     severity=error_data.get("severity", "medium")
-                ))
-            
-            return errors
+                )
+                for error_data in ai_errors_data
+            ])
         except Exception as e:
             logger.warning(f"AI error detection failed: {str(e)}")
+            _note_ai_fallback("error detection")
             return []
     
+    def _intern_errors(self, errors: List[FormulaError]) -> List[FormulaError]:
+        """
+        Drop repeated findings and swap each for a stored identical instance.
+        
+        Findings are left as-is if the AI put unhashable values in any field.
+        """
+        try:
+            unique = list(dict.fromkeys(errors))
+        except TypeError:
+            return errors
+        
+        if len(self._interned_errors) + len(unique) > INTERNED_ERRORS_SIZE:
+            self._interned_errors.clear()
+        return [self._interned_errors.setdefault(error, error) for error in unique]
+    
+    def _error_detection_prompt(self, sections: List[str]) -> str:
+        """Build the error detection prompt for one or more formula sections"""
+        if len(sections) == 1:
+            return _ERROR_DETECTION_TEMPLATE.format(
+                subject="this Excel formula",
+                formulas=sections[0],
+                error_types=self._error_types_json,
+                output=_ERROR_DETECTION_OUTPUT
+            )
+        
+        return _ERROR_DETECTION_TEMPLATE.format(
+            subject=f"each of these {len(sections)} Excel formulas",
+            formulas="".join(
+                f"\n        Formula #{index}:{section}" for index, section in enumerate(sections)
+            ),
+            error_types=self._error_types_json,
+            output=_ERROR_DETECTION_BATCH_OUTPUT
+        )
+    
+    async def _detect_errors_batch(self, sections: List[str]) -> List[Any]:
+        """Run AI error detection for a batch of formula sections in one request"""
+        prompt = self._error_detection_prompt(sections)
+        parsed = await self._fetch_ai_json(
+            prompt, min(ERROR_DETECTION_MAX_TOKENS * len(sections), server_config.ai_batch_max_tokens)
+        )
+        if len(sections) == 1:
+            return [parsed]
+        
+        if not isinstance(parsed, list) or len(parsed) != len(sections):
+            raise ValueError(f"Expected findings for {len(sections)} formulas")
+        return parsed
+    
     async def _generate_solutions(self, 
                                 formula: str, 
                                 errors: List[FormulaError],
-                                analysis: Dict) -> List[Dict]:
+                                analysis: Dict,
+                                scan: ReferenceScan) -> List[Dict]:
         """Generate solutions for identified errors"""
         if not errors:
             return [{"formula": formula, "description": "No errors found", "changes": []}]
@@ -791,119 +1635,108 @@ class FormulaDebugger:
         solutions = []
         
         for error in errors:
-            if error.error_type in self.error_patterns:
-                # Use predefined solutions
-                error_info = self.error_patterns[error.error_type]
-                for i, solution in enumerate(error_info["solutions"][:2]):  # Limit to 2 solutions
-                    corrected_formula = await self._apply_solution(formula, error, solution)
-                    solutions.append({
-                        "formula": corrected_formula,
+            error_info = self.error_patterns.get(error.error_type)
+            if error_info is not None:
+                # Use predefined solutions, limited to 2
+                solutions.extend([
+                    {
+                        "formula": self._apply_solution(formula, error, solution),
                         "description": solution,
                         "changes": [f"Fixed {error.error_type} error"],
                         "confidence": 0.8 - (i * 0.1)
-                    })
+                    }
+                    for i, solution in enumerate(error_info["solutions"][:2])
+                ])
             else:
-                # Use AI to generate solution
-                ai_solution = await self._ai_generate_solution(formula, error, analysis)
+                # Reuse a fix learned on a formula of the same structure, else ask the AI
+                ai_solution = self._solution_from_template(scan, error)
+                if ai_solution is None:
+                    ai_solution = await self._ai_generate_solution(formula, error, analysis, scan)
+                    if ai_solution:
+                        self._learn_solution_template(scan, error, ai_solution)
                 if ai_solution:
                     solutions.append(ai_solution)
+                else:
+                    _note_ai_fallback("solution")
         
         return solutions
     
-    async def _apply_solution(self, formula: str, error: FormulaError, solution: str) -> str:
+    def _apply_solution(self, formula: str, error: FormulaError, solution: str) -> str:
         """Apply a solution to fix the formula"""
         # This is a simplified implementation
         # In practice, you'd need more sophisticated pattern matching and replacement
+        fixer = _SOLUTION_FIXERS.get(error.error_type)
+        return fixer(formula) if fixer else formula
+    
+    def _solution_from_template(self, scan: ReferenceScan, error: FormulaError) -> Optional[Dict]:
+        """Instantiate a learned fix for this error type and formula structure, if any"""
+        template = self._solution_templates.get(ResponseCache.make_key(error.error_type, scan.structure))
+        if template is None:
+            return None
+        return _fill_reference_slots(template, scan.cells)
+    
+    def _learn_solution_template(self, scan: ReferenceScan, error: FormulaError, solution: Any) -> None:
+        """
+        Generalize an AI fix over the formula's references for reuse.
         
-        if error.error_type == "#DIV/0!":
-            # Wrap division operations with IFERROR
-            division_pattern = r'([A-Z\d:]+)/([A-Z\d:]+)'
-            if re.search(division_pattern, formula):
-                formula = re.sub(division_pattern, r'IFERROR(\1/\2, "")', formula)
-        
-        elif error.error_type == "#N/A":
-            # Wrap lookup functions with IFERROR
-            if 'VLOOKUP' in formula:
-                formula = re.sub(r'VLOOKUP\([^)]+\)', r'IFERROR(&, "Not Found")', formula)
-        
-        return formula
+        Only fixes whose corrected formula is well formed and refers to no
+        cells beyond the original formula's are kept; anything else depends on
+        the specific cells and could not be carried to another formula.
+        """
+        corrected = solution.get("formula") if isinstance(solution, dict) else None
+        if not isinstance(corrected, str) or not _tokenize_formula(corrected).parentheses_balanced:
+            return
+        
+        template = _replace_references(solution, {
+            reference: f'\0{slot}\0' for slot, reference in enumerate(scan.cells)
+        })
+        if _RE_CELL_REF.search(template["formula"]):
+            return
+        self._solution_templates.set(ResponseCache.make_key(error.error_type, scan.structure), template)
     
     async def _ai_generate_solution(self, 
                                   formula: str, 
                                   error: FormulaError,
-                                  analysis: Dict) -> Optional[Dict]:
+                                  analysis: Dict,
+                                  scan: ReferenceScan) -> Optional[Dict]:
         """Use AI to generate solution for complex errors"""
-        prompt = f"""
-        Fix this Excel formula error:
-        
-        Original Formula: {formula}
-        Error: {error.error_type} - {error.description}
-        Suggestion: {error.suggestion}
-        Analysis: {json.dumps(analysis, indent=2)}
-        
-        Provide:
-        1. Corrected formula
-        2. Explanation of changes made
-        3. Why this solution works
-        
-        Return as JSON with formula, description, changes, confidence fields.
-        """
+        prompt = _SOLUTION_PROMPT_TEMPLATE.format(
+            formula=formula,
+            error_type=error.error_type,
+            description=error.description,
+            suggestion=error.suggestion,
+            analysis=_prompt_json(_project_analysis("solution", analysis))
+        )
         
         try:
-            response = await self.ai_service.generate_response(prompt, max_tokens=400)
-            solution_data = json.loads(response)
-            return solution_data
+            return await self._ask_ai_json(prompt, max_tokens=400, shape=scan.shape, opening="{")
         except Exception as e:
             logger.warning(f"AI solution generation failed: {str(e)}")
             return None
     
-    async def _suggest_optimizations(self, formula: str, analysis: Dict) -> List[Dict]:
+    async def _suggest_optimizations(self, formula: str, analysis: Dict, scan: ReferenceScan) -> List[Dict]:
         """Suggest formula optimizations"""
-        optimizations = []
-        
-        # Check for performance improvements
-        if analysis["complexity_score"] > 5:
-            optimizations.append({
-                "type": "performance",
-                "description": "Formula complexity is high, consider breaking into multiple cells",
-                "suggestion": "Split complex operations into intermediate calculations"
-            })
-        
-        # Check for newer function alternatives
-        if 'VLOOKUP' in formula:
-            optimizations.append({
-                "type": "modern_alternative",
-                "description": "Consider using XLOOKUP instead of VLOOKUP for better performance",
-                "suggestion": "Replace VLOOKUP with XLOOKUP if using Excel 365"
-            })
+        optimizations = list(_suggest_optimizations_local(
+            analysis["complexity_score"],
+            'VLOOKUP' in _function_triggers(formula)
+        ))
         
         # Use AI for advanced optimizations
-        ai_optimizations = await self._ai_suggest_optimizations(formula, analysis)
+        ai_optimizations = await self._ai_suggest_optimizations(formula, analysis, scan)
         optimizations.extend(ai_optimizations)
         
         return optimizations
     
-    async def _ai_suggest_optimizations(self, formula: str, analysis: Dict) -> List[Dict]:
+    async def _ai_suggest_optimizations(self, formula: str, analysis: Dict, scan: ReferenceScan) -> List[Dict]:
         """Use AI to suggest optimizations"""
-        prompt = f"""
-        Suggest optimizations for this Excel formula:
-        
-        Formula: {formula}
-        Analysis: {json.dumps(analysis, indent=2)}
-        
-        Look for:
-        1. Performance improvements
-        2. Modern function alternatives
-        3. Simplification opportunities
-        4. Better error handling
-        5. Readability improvements
-        
-        Return as JSON array with type, description, suggestion fields.
-        """
+        prompt = _OPTIMIZATION_PROMPT_TEMPLATE.format(
+            formula=formula,
+            analysis=_prompt_json(_project_analysis("optimizations", analysis))
+        )
         
         try:
-            response = await self.ai_service.generate_response(prompt, max_tokens=300)
-            return json.loads(response)
+            return await self._ask_ai_json(prompt, max_tokens=300, shape=scan.shape)
         except Exception as e:
             logger.warning(f"AI optimization suggestions failed: {str(e)}")
+            _note_ai_fallback("optimizations")
             return []
\ No newline at end of file
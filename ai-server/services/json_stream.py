@@ -0,0 +1,170 @@
+"""
+Incremental JSON Extraction for Manice Excel AI Copilot
+Pulls completed items out of a JSON array while the model is still generating,
+and the first complete JSON value out of a finished reply
+"""
+
+from typing import Any, Dict, List, Optional
+
+import orjson
+
+
+class ArrayItemStream:
+    """
+    Incrementally extract the objects of one array field from streamed JSON text
+
+    Text chunks are fed as they arrive; each object in the target array is
+    decoded as soon as its closing brace is seen, so callers can act on early
+    items before the rest of the document exists. Only string/escape state and
+    nesting depth are tracked, which is all that is needed to find item bounds.
+    """
+
+    def __init__(self, field_name: str):
+        self._marker = f'"{field_name}"'
+        self._text: List[str] = []
+        self._buffer = ""
+        self._position = 0
+        self._in_array = False
+        self._finished = False
+        self._depth = 0
+        self._item_start = -1
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk: str) -> List[Any]:
+        """Consume a text chunk and return any array items it completed"""
+        self._text.append(chunk)
+        if self._finished:
+            return []
+
+        self._buffer += chunk
+        if not self._in_array and not self._find_array_start():
+            return []
+
+        return self._scan_items()
+
+    def document(self) -> Optional[Dict[str, Any]]:
+        """Decode the full streamed text, or None if it is not a JSON object"""
+        try:
+            parsed = orjson.loads("".join(self._text))
+        except orjson.JSONDecodeError:
+            return None
+        return parsed if isinstance(parsed, dict) else None
+
+    @property
+    def text(self) -> str:
+        """All text fed so far"""
+        return "".join(self._text)
+
+    def _find_array_start(self) -> bool:
+        key_index = self._buffer.find(self._marker)
+        if key_index < 0:
+            # Keep a tail long enough to match a marker split across chunks
+            keep = len(self._marker) - 1
+            if len(self._buffer) > keep:
+                self._buffer = self._buffer[-keep:]
+            return False
+
+        bracket_index = self._buffer.find("[", key_index + len(self._marker))
+        if bracket_index < 0:
+            return False
+
+        self._buffer = self._buffer[bracket_index + 1:]
+        self._position = 0
+        self._in_array = True
+        return True
+
+    def _scan_items(self) -> List[Any]:
+        items = []
+        buffer = self._buffer
+        index = self._position
+
+        while index < len(buffer):
+            char = buffer[index]
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                if self._depth == 0:
+                    self._item_start = index
+                self._depth += 1
+            elif char in "}]":
+                if self._depth == 0:
+                    # Closing bracket of the target array itself
+                    self._finished = True
+                    break
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        items.append(orjson.loads(buffer[self._item_start:index + 1]))
+                    except orjson.JSONDecodeError:
+                        pass
+                    self._item_start = -1
+
+            index += 1
+
+        # Drop consumed text, keeping only a partially received item
+        if self._item_start >= 0:
+            self._buffer = buffer[self._item_start:]
+            self._position = index - self._item_start
+            self._item_start = 0
+        else:
+            self._buffer = ""
+            self._position = 0
+
+        return items
+
+
+def decode_first(text: str, opening: str = "[") -> Any:
+    """
+    Decode the first JSON array or object in text, ignoring anything around it
+
+    Model replies often wrap the requested JSON in prose or code fences. The
+    scan starts at the first opening bracket and stops as soon as its match
+    closes, so trailing text is never parsed. Raises ValueError if no complete
+    value is found.
+    """
+    # Well-formed bare replies decode directly without the bracket scan
+    stripped = text.strip()
+    if stripped.startswith(opening):
+        try:
+            return orjson.loads(stripped)
+        except orjson.JSONDecodeError:
+            pass
+
+    closing = "]" if opening == "[" else "}"
+    start = text.find(opening)
+    if start < 0:
+        raise ValueError(f"No JSON value starting with {opening!r} in response")
+
+    depth = 0
+    in_string = False
+    escaped = False
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            depth += 1
+        elif char in "}]":
+            depth -= 1
+            if depth == 0:
+                if char != closing:
+                    break
+                return orjson.loads(text[start:index + 1])
+
+    raise ValueError(f"Unterminated JSON value starting with {opening!r} in response")
@@ -3,20 +3,177 @@ VBA Macro Automation Engine for Manice Excel AI Copilot
 Provides AI-powered VBA macro generation, analysis, and optimization
 """
 
-from typing import Dict, List, Optional, Any, Union
+from typing import Callable, Dict, FrozenSet, List, Optional, Any, Pattern, Tuple
+import asyncio
 import re
-import json
 from dataclasses import dataclass
+from functools import lru_cache
 from enum import Enum
 from loguru import logger
+import orjson
 
-class MacroComplexity(Enum):
+from .json_stream import decode_first
+from .micro_batch import MicroBatcher
+from .response_cache import ResponseCache, SingleFlight
+
+try:
+    from ..config import server_config
+except ImportError:
+    from config import server_config
+
+# Security scans kept per engine, keyed by macro code; generated code is often analyzed next
+SECURITY_SCAN_CACHE_SIZE = 256
+
+# AI security reviews arriving together share one request, up to this many macros
+SECURITY_REVIEW_BATCH_SIZE = 8
+SECURITY_REVIEW_BATCH_DELAY = 0.01
+SECURITY_REVIEW_MAX_TOKENS = 300
+
+# Macros analyzed at once by analyze_macros
+MACRO_ANALYSIS_CONCURRENCY = 8
+
+# Requirement keywords per operation, in priority order for the main operation,
+# matched against whole words rather than substrings
+_OPERATION_WORDS = {
+    'sort': frozenset({'sort', 'sorts', 'sorted', 'sorting', 'order', 'orders', 'ordered', 'ordering',
+                       'arrange', 'arranges', 'arranged', 'arranging'}),
+    'filter': frozenset({'filter', 'filters', 'filtered', 'filtering', 'search', 'searches', 'searching',
+                         'find', 'finds', 'finding'}),
+    'format': frozenset({'format', 'formats', 'formatted', 'formatting', 'style', 'styles', 'styled', 'styling',
+                         'color', 'colors', 'colored', 'coloring'}),
+    'copy': frozenset({'copy', 'copies', 'copied', 'copying', 'duplicate', 'duplicates', 'duplicated',
+                       'duplicating', 'clone', 'clones', 'cloned', 'cloning'}),
+    'delete': frozenset({'delete', 'deletes', 'deleted', 'deleting', 'remove', 'removes', 'removed', 'removing',
+                         'clear', 'clears', 'cleared', 'clearing'}),
+    'email': frozenset({'email', 'emails', 'emailed', 'emailing', 'send', 'sends', 'sending',
+                        'mail', 'mails', 'mailed', 'mailing'}),
+    'save': frozenset({'save', 'saves', 'saved', 'saving', 'export', 'exports', 'exported', 'exporting',
+                       'output', 'outputs'}),
+    'chart': frozenset({'chart', 'charts', 'graph', 'graphs', 'plot', 'plots', 'plotted', 'plotting'})
+}
+_USER_INPUT_WORDS = frozenset({'input', 'inputs', 'prompt', 'prompts', 'prompted', 'ask', 'asks', 'asked', 'asking'})
+_FILE_WORDS = frozenset({'file', 'files', 'filename', 'save', 'saves', 'saved', 'saving', 'open', 'opens', 'opened',
+                         'opening', 'import', 'imports', 'imported', 'importing',
+                         'export', 'exports', 'exported', 'exporting'})
+_EXTERNAL_WORDS = frozenset({'email', 'emails', 'emailed', 'emailing', 'internet', 'web', 'website', 'api', 'apis'})
+_COMPLEX_WORDS = frozenset({'loop', 'loops', 'looping', 'condition', 'conditions', 'conditional', 'if',
+                            'array', 'arrays', 'dictionary', 'dictionaries', 'class', 'classes'})
+_RE_WORDS = re.compile(r'\w+')
+
+# Words that add nothing to a requirement beyond its operation; a requirement made
+# only of these and its operation's keywords is answered by the matching template
+_TEMPLATE_FILLER_WORDS = frozenset({'a', 'an', 'the', 'my', 'this', 'these', 'all', 'data', 'sheet', 'worksheet',
+                                    'active', 'current', 'table', 'range', 'rows', 'on', 'in', 'of', 'to', 'for',
+                                    'please', 'macro', 'vba', 'create', 'write', 'make', 'generate', 'that', 'i',
+                                    'want', 'need', 'me'})
+
+# Objects created by ProgID and parameter lists of Sub/Function declarations.
+# Both branches are lookaheads so one kind of match never hides another.
+_RE_CODE_DECLARATION = re.compile(
+    r'(?=(?P<kind>CreateObject)\("(?P<object>[^"]+)"\)'
+    r'|(?P<decl>Sub|Function)\s+\w+\s*\((?P<parameters>[^)]+)\))'
+)
+
+# The "As" keyword between a parameter name and its type, with any spacing or case
+_RE_AS_CLAUSE = re.compile(r'\s+As\s+', re.IGNORECASE)
+
+# Score added per matching pattern in each regex bucket of the security patterns
+_SECURITY_PATTERN_WEIGHTS = {
+    "risky_patterns": 2,
+    "file_operations": 1,
+    "external_access": 2
+}
+
+# Dangerous names that stand for a family of identifiers, such as FileSystemObject
+_DANGEROUS_NAME_PREFIXES = frozenset({"FileSystem"})
+
+def _whole_word_pattern(word: str, prefix: bool = False) -> Pattern:
+    """Match word only where it is not part of a longer identifier, or only at its start if prefix"""
+    escaped = re.escape(word)
+    # Leading with the literal lets re scan for it directly; the boundaries are checked after
+    if prefix:
+        return re.compile(rf"{escaped}(?<!\w{escaped})")
+    return re.compile(rf"{escaped}(?!\w)(?<!\w{escaped})")
+
+def _prompt_json(value: Any) -> str:
+    """Serialize a value for a prompt, indented for the model to read"""
+    return orjson.dumps(value, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+
+@lru_cache(maxsize=1024)
+def _requirement_words(requirement: str) -> FrozenSet[str]:
+    """Distinct lowercased words of a requirement"""
+    return frozenset(_RE_WORDS.findall(requirement.lower()))
+
+# Statements that close or open an indented block in generated code; keywords
+# without a trailing space must end there, so NextRow = 1 is not a Next
+_RE_BLOCK_CLOSER = re.compile(r'End |(?:Next|Loop|Wend)\b')
+_RE_BLOCK_OPENER = re.compile(r'Sub |Function |If |For |While |With |(?:Do|Select Case|Try)\b')
+
+# Markdown code fences around generated code
+_RE_VBA_FENCE = re.compile(r'```vba\n?')
+_RE_CODE_FENCE = re.compile(r'```\n?')
+
+def _indent_vba_lines(lines: List[str]) -> List[str]:
+    """Re-indent stripped VBA lines by block nesting; blank lines stay empty"""
+    indented = []
+    indent_level = 0
+    
+    for line in lines:
+        line = line.strip()
+        if not line:
+            indented.append('')
+            continue
+        
+        # Decrease indent for End statements
+        if _RE_BLOCK_CLOSER.match(line):
+            indent_level = max(0, indent_level - 1)
+        
+        indented.append('    ' * indent_level + line)
+        
+        # Increase indent for structure statements
+        if _RE_BLOCK_OPENER.match(line):
+            indent_level += 1
+    
+    return indented
+
+@dataclass(frozen=True)
+class CodeScan:
+    """Created objects and declared parameter lists of macro code, collected in one pass"""
+    __slots__ = ('created_objects', 'sub_parameters', 'function_parameters')
+    
+    created_objects: Tuple[str, ...]
+    sub_parameters: Tuple[str, ...]
+    function_parameters: Tuple[str, ...]
+
+@lru_cache(maxsize=256)
+def _scan_code(code: str) -> CodeScan:
+    """Scan macro code once for everything the dependency and parameter extractors need"""
+    found: Dict[str, List[str]] = {'CreateObject': [], 'Sub': [], 'Function': []}
+    # Matches of the same kind must not overlap, as with a separate findall per kind
+    scanned_to = dict.fromkeys(found, 0)
+    for match in _RE_CODE_DECLARATION.finditer(code):
+        kind = match.group('kind') or match.group('decl')
+        if match.start() < scanned_to[kind]:
+            continue
+        if kind == 'CreateObject':
+            found[kind].append(match.group('object'))
+            scanned_to[kind] = match.end('object') + 2
+        else:
+            found[kind].append(match.group('parameters'))
+            scanned_to[kind] = match.end('parameters') + 1
+    return CodeScan(
+        created_objects=tuple(found['CreateObject']),
+        sub_parameters=tuple(found['Sub']),
+        function_parameters=tuple(found['Function'])
+    )
+
+class MacroComplexity(str, Enum):
     SIMPLE = "simple"
     MODERATE = "moderate"
     COMPLEX = "complex"
     ADVANCED = "advanced"
 
-class MacroCategory(Enum):
+class MacroCategory(str, Enum):
     DATA_MANIPULATION = "data_manipulation"
     FORMATTING = "formatting"
     AUTOMATION = "automation"
@@ -28,14 +185,27 @@ class MacroCategory(Enum):
     VALIDATION = "validation"
     INTEGRATION = "integration"
 
-class SecurityLevel(Enum):
+# Template group offered to the model for each macro category; others get automation
+_TEMPLATE_GROUP_BY_CATEGORY = {
+    MacroCategory.DATA_MANIPULATION: "data_manipulation",
+    MacroCategory.FORMATTING: "formatting",
+    MacroCategory.AUTOMATION: "automation",
+    MacroCategory.FILE_OPERATIONS: "file_operations",
+    MacroCategory.REPORTING: "reporting"
+}
+
+class SecurityLevel(str, Enum):
     SAFE = "safe"
     MODERATE = "moderate"
     HIGH_RISK = "high_risk"
     DANGEROUS = "dangerous"
 
+# Explicit __slots__ keep instances dict-free; dataclass(slots=True) is not available before Python 3.10
 @dataclass
 class VBAMacro:
+    __slots__ = ('name', 'code', 'description', 'category', 'complexity', 'security_level',
+                 'dependencies', 'parameters', 'usage_examples', 'warnings', 'performance_notes')
+    
     name: str
     code: str
     description: str
@@ -50,6 +220,9 @@ class VBAMacro:
 
 @dataclass
 class MacroAnalysis:
+    __slots__ = ('security_issues', 'performance_issues', 'best_practices', 'optimization_suggestions',
+                 'code_quality_score', 'maintainability_score', 'overall_rating')
+    
     security_issues: List[str]
     performance_issues: List[str]
     best_practices: List[str]
@@ -58,20 +231,10 @@ class MacroAnalysis:
     maintainability_score: float
     overall_rating: str
 
-class VBAMacroEngine:
-    """AI-powered VBA macro generation and analysis"""
-    
-    def __init__(self, ai_service):
-        self.ai_service = ai_service
-        self.vba_templates = self._load_vba_templates()
-        self.security_patterns = self._load_security_patterns()
-        self.best_practices = self._load_best_practices()
-        
-    def _load_vba_templates(self) -> Dict:
-        """Load common VBA macro templates"""
-        return {
-            "data_manipulation": {
-                "sort_data": '''
+# Common VBA macro templates; static, so shared by all engines
+_VBA_TEMPLATES = {
+    "data_manipulation": {
+        "sort_data": '''
 Sub SortData()
     Dim ws As Worksheet
     Dim dataRange As Range
@@ -82,7 +245,7 @@ Sub SortData()
     dataRange.Sort Key1:=dataRange.Columns(1), Order1:=xlAscending, Header:=xlYes
 End Sub
                 ''',
-                "filter_data": '''
+        "filter_data": '''
 Sub FilterData(criteria As String)
     Dim ws As Worksheet
     Set ws = ActiveSheet
@@ -90,7 +253,7 @@ Sub FilterData(criteria As String)
     ws.Range("A1").AutoFilter Field:=1, Criteria1:=criteria
 End Sub
                 ''',
-                "remove_duplicates": '''
+        "remove_duplicates": '''
 Sub RemoveDuplicates()
     Dim ws As Worksheet
     Dim dataRange As Range
@@ -101,9 +264,9 @@ Sub RemoveDuplicates()
     dataRange.RemoveDuplicates Columns:=1, Header:=xlYes
 End Sub
                 '''
-            },
-            "formatting": {
-                "format_table": '''
+    },
+    "formatting": {
+        "format_table": '''
 Sub FormatTable()
     Dim ws As Worksheet
     Dim tbl As ListObject
@@ -114,7 +277,7 @@ Sub FormatTable()
     tbl.TableStyle = "TableStyleMedium2"
 End Sub
                 ''',
-                "conditional_formatting": '''
+        "conditional_formatting": '''
 Sub ApplyConditionalFormatting()
     Dim ws As Worksheet
     Dim rng As Range
@@ -125,9 +288,9 @@ Sub ApplyConditionalFormatting()
     rng.FormatConditions.AddColorScale ColorScaleType:=3
 End Sub
                 '''
-            },
-            "automation": {
-                "copy_sheets": '''
+    },
+    "automation": {
+        "copy_sheets": '''
 Sub CopySheets()
     Dim srcWb As Workbook
     Dim destWb As Workbook
@@ -141,7 +304,7 @@ Sub CopySheets()
     Next ws
 End Sub
                 ''',
-                "email_report": '''
+        "email_report": '''
 Sub EmailReport()
     Dim OutApp As Object
     Dim OutMail As Object
@@ -158,9 +321,9 @@ Sub EmailReport()
     End With
 End Sub
                 '''
-            },
-            "file_operations": {
-                "save_as_pdf": '''
+    },
+    "file_operations": {
+        "save_as_pdf": '''
 Sub SaveAsPDF()
     Dim ws As Worksheet
     Dim fileName As String
@@ -171,7 +334,7 @@ Sub SaveAsPDF()
     ws.ExportAsFixedFormat Type:=xlTypePDF, fileName:=fileName
 End Sub
                 ''',
-                "import_csv": '''
+        "import_csv": '''
 Sub ImportCSV(filePath As String)
     Dim ws As Worksheet
     Dim qt As QueryTable
@@ -186,9 +349,9 @@ Sub ImportCSV(filePath As String)
     End With
 End Sub
                 '''
-            },
-            "reporting": {
-                "create_summary": '''
+    },
+    "reporting": {
+        "create_summary": '''
 Sub CreateSummary()
     Dim ws As Worksheet
     Dim summaryWs As Worksheet
@@ -204,7 +367,7 @@ Sub CreateSummary()
     summaryWs.Range("A2").Value = "Average: " & Application.WorksheetFunction.Average(dataRange.Columns(2))
 End Sub
                 ''',
-                "pivot_table": '''
+        "pivot_table": '''
 Sub CreatePivotTable()
     Dim ws As Worksheet
     Dim pivotWs As Worksheet
@@ -218,79 +381,212 @@ Sub CreatePivotTable()
     Set pivotTable = pivotCache.CreatePivotTable(pivotWs.Range("A1"))
 End Sub
                 '''
-            }
+    }
+}
+
+# Risky pattern that generated-macro warnings single out
+_EVENTS_DISABLED_PATTERN = r"Application\.EnableEvents\s*=\s*False"
+
+# Security patterns and risks; static, so shared by all engines
+_SECURITY_PATTERNS = {
+    "dangerous_functions": [
+        "Shell", "CreateObject", "GetObject", "Environ", 
+        "Dir", "Kill", "RmDir", "MkDir", "ChDir", "ChDrive",
+        "FileSystem", "Scripting.FileSystemObject"
+    ],
+    "risky_patterns": [
+        _EVENTS_DISABLED_PATTERN,
+        r"Application\.ScreenUpdating\s*=\s*False",
+        r"\.Execute\s*\(",
+        r"\.Run\s*\(",
+        r"SendKeys",
+        r"DoEvents",
+        r"Application\.Wait",
+        r"Sleep"
+    ],
+    "file_operations": [
+        r"Open\s+.+For\s+(Input|Output|Append)",
+        r"\.OpenText",
+        r"\.SaveAs",
+        r"\.Delete",
+        r"\.Move",
+        r"\.Copy"
+    ],
+    "external_access": [
+        r"CreateObject\(.*(Excel|Word|PowerPoint|Outlook).*\)",
+        r"CreateObject\(.*(Internet|Http|XML).*\)",
+        r"CreateObject\(.*(Shell|WScript).*\)"
+    ]
+}
+
+# VBA best practices; static, so shared by all engines
+_BEST_PRACTICES = {
+    "variable_declaration": [
+        "Always use Option Explicit",
+        "Declare variables with specific types",
+        "Use meaningful variable names",
+        "Initialize variables properly"
+    ],
+    "error_handling": [
+        "Always include error handling",
+        "Use On Error GoTo for critical sections",
+        "Clean up objects and resources",
+        "Provide meaningful error messages"
+    ],
+    "performance": [
+        "Turn off screen updating for long operations",
+        "Disable automatic calculations when needed",
+        "Use arrays for bulk data operations",
+        "Avoid selecting ranges unnecessarily"
+    ],
+    "maintainability": [
+        "Break complex procedures into smaller functions",
+        "Use comments to explain complex logic",
+        "Follow consistent naming conventions",
+        "Avoid hard-coded values"
+    ]
+}
+
+# Generated-macro warning for each security level that needs one
+_SECURITY_LEVEL_WARNINGS = {
+    SecurityLevel.DANGEROUS: "⚠️ DANGEROUS: This macro contains potentially harmful operations",
+    SecurityLevel.HIGH_RISK: "⚠️ HIGH RISK: Review this macro carefully before running",
+    SecurityLevel.MODERATE: "⚠️ MODERATE RISK: This macro performs system operations"
+}
+
+# Specific risk warnings, raised when any of their security scan hits is present
+_RISK_WARNING_RULES: Tuple[Tuple[FrozenSet[str], str], ...] = (
+    (frozenset({"Shell"}), "This macro executes external programs"),
+    (frozenset({"CreateObject"}), "This macro creates external objects"),
+    (frozenset({"FileSystem", "Scripting.FileSystemObject"}), "This macro modifies files or folders"),
+    (frozenset({_EVENTS_DISABLED_PATTERN}), "This macro disables Excel events")
+)
+
+# Performance notes for generated code, in reporting order
+_PERFORMANCE_NOTE_RULES: Tuple[Tuple[Callable[[str], bool], str], ...] = (
+    (lambda code: "ScreenUpdating" in code and "False" in code,
+     "Screen updating disabled for better performance"),
+    (lambda code: "UsedRange" in code, "Performance depends on data size"),
+    (lambda code: "Loop" in code or "For" in code, "Contains loops - execution time varies with data"),
+    (lambda code: "AutoFilter" in code, "Uses AutoFilter - ensure data is properly formatted")
+)
+
+# Code markers that imply a dependency beyond the created objects
+_DEPENDENCY_MARKERS = (
+    ("References", "Additional References Required"),
+    ("AddIns", "Excel Add-ins")
+)
+
+# AI security review prompt, for one macro or a batch of numbered macros
+_SECURITY_REVIEW_TEMPLATE = """
+            Analyze {subject} for security vulnerabilities:
+            {macros}
+            
+            Look for:
+            1. File system access
+            2. External program execution
+            3. Network access
+            4. Registry modifications
+            5. Privilege escalation
+            6. Data exposure risks
+            
+            {output}
+            """
+
+_SECURITY_REVIEW_BATCH_OUTPUT = (
+    "Return a JSON array with one entry per macro, in the order given. "
+    "Each entry is a JSON array of security concerns as strings."
+)
+
+class VBAMacroEngine:
+    """AI-powered VBA macro generation and analysis"""
+    
+    def __init__(self, ai_service):
+        self.ai_service = ai_service
+        self.vba_templates = self._load_vba_templates()
+        self.security_patterns = self._load_security_patterns()
+        self.best_practices = self._load_best_practices()
+        # Regex buckets compiled once, case-insensitive, paired with their source pattern
+        self._compiled_security = self._compile_security_patterns()
+        # Dangerous function names matched as whole identifiers, so MyShellHelper is not Shell;
+        # FileSystem also covers the identifiers it starts, like early-bound FileSystemObject
+        self._dangerous_functions = [
+            (func, _whole_word_pattern(func, func in _DANGEROUS_NAME_PREFIXES))
+            for func in self.security_patterns["dangerous_functions"]
+        ]
+        self._ai_cache = ResponseCache(
+            max_size=server_config.ai_response_cache_size, ttl=server_config.response_cache_ttl
+        )
+        self._ai_inflight = SingleFlight()
+        self._security_scans: Dict[str, Tuple[int, Tuple[str, ...], FrozenSet[str]]] = {}
+        self._security_review_batcher = MicroBatcher(
+            self._review_security_batch,
+            # Every macro in a batch keeps its full share of the reply
+            max_size=max(1, min(SECURITY_REVIEW_BATCH_SIZE, server_config.ai_batch_max_tokens // SECURITY_REVIEW_MAX_TOKENS)),
+            max_delay=SECURITY_REVIEW_BATCH_DELAY
+        )
+        # Static prompt sections serialized once rather than per request
+        self._best_practices_json = _prompt_json(self.best_practices)
+        self._templates_json = {
+            group: _prompt_json(templates) for group, templates in self.vba_templates.items()
         }
+        
+    def _load_vba_templates(self) -> Dict:
+        """Load common VBA macro templates"""
+        return _VBA_TEMPLATES
     
     def _load_security_patterns(self) -> Dict:
         """Load security patterns and risks"""
+        return _SECURITY_PATTERNS
+    
+    def _compile_security_patterns(self) -> Dict[str, List[Tuple[str, Pattern]]]:
+        """Compile the regex buckets of the security patterns"""
         return {
-            "dangerous_functions": [
-                "Shell", "CreateObject", "GetObject", "Environ", 
-                "Dir", "Kill", "RmDir", "MkDir", "ChDir", "ChDrive",
-                "FileSystem", "Scripting.FileSystemObject"
-            ],
-            "risky_patterns": [
-                r"Application\.EnableEvents\s*=\s*False",
-                r"Application\.ScreenUpdating\s*=\s*False",
-                r"\.Execute\s*\(",
-                r"\.Run\s*\(",
-                r"SendKeys",
-                r"DoEvents",
-                r"Application\.Wait",
-                r"Sleep"
-            ],
-            "file_operations": [
-                r"Open\s+.+For\s+(Input|Output|Append)",
-                r"\.OpenText",
-                r"\.SaveAs",
-                r"\.Delete",
-                r"\.Move",
-                r"\.Copy"
-            ],
-            "external_access": [
-                r"CreateObject\(.*(Excel|Word|PowerPoint|Outlook).*\)",
-                r"CreateObject\(.*(Internet|Http|XML).*\)",
-                r"CreateObject\(.*(Shell|WScript).*\)"
-            ]
+            category: [(pattern, re.compile(pattern, re.IGNORECASE)) for pattern in self.security_patterns[category]]
+            for category in _SECURITY_PATTERN_WEIGHTS
         }
     
     def _load_best_practices(self) -> Dict:
         """Load VBA best practices"""
-        return {
-            "variable_declaration": [
-                "Always use Option Explicit",
-                "Declare variables with specific types",
-                "Use meaningful variable names",
-                "Initialize variables properly"
-            ],
-            "error_handling": [
-                "Always include error handling",
-                "Use On Error GoTo for critical sections",
-                "Clean up objects and resources",
-                "Provide meaningful error messages"
-            ],
-            "performance": [
-                "Turn off screen updating for long operations",
-                "Disable automatic calculations when needed",
-                "Use arrays for bulk data operations",
-                "Avoid selecting ranges unnecessarily"
-            ],
-            "maintainability": [
-                "Break complex procedures into smaller functions",
-                "Use comments to explain complex logic",
-                "Follow consistent naming conventions",
-                "Avoid hard-coded values"
-            ]
-        }
+        return _BEST_PRACTICES
+    
+    async def _ask_ai(self, prompt: str, max_tokens: int, use_cache: bool = True) -> Any:
+        """Query the AI service, reusing the answer for a prompt already asked or in flight"""
+        if not use_cache:
+            return await self.ai_service.generate_response(prompt, max_tokens=max_tokens)
+        
+        cache_key = ResponseCache.make_key(prompt, max_tokens)
+        cached = self._ai_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        response = await self._ai_inflight.run(
+            cache_key,
+            lambda: self.ai_service.generate_response(prompt, max_tokens=max_tokens)
+        )
+        self._ai_cache.set(cache_key, response)
+        return response
     
     async def generate_macro(self, 
                            requirement: str, 
                            context: Optional[Dict] = None,
-                           constraints: Optional[Dict] = None) -> VBAMacro:
-        """Generate VBA macro based on natural language requirement"""
+                           constraints: Optional[Dict] = None,
+                           use_cache: bool = True) -> VBAMacro:
+        """
+        Generate VBA macro based on natural language requirement
+        
+        Requirement analysis, description and usage examples reuse earlier AI
+        answers to the same prompt unless use_cache is False. Simple requests
+        that a built-in template already covers are answered without the AI.
+        """
+        if not context and not constraints:
+            template_macro = self._template_macro(requirement)
+            if template_macro is not None:
+                return template_macro
+        
         try:
             # Analyze the requirement
-            analysis = await self._analyze_requirement(requirement, context)
+            analysis = await self._analyze_requirement(requirement, context, use_cache)
             
             # Determine category and complexity
             category = self._determine_category(requirement, analysis)
@@ -304,11 +600,11 @@ End Sub
             
             # Generate metadata
             name = self._generate_macro_name(requirement, analysis)
-            description = await self._generate_description(requirement, code, analysis)
+            description = await self._generate_description(requirement, code, analysis, use_cache)
             dependencies = self._extract_dependencies(code)
             parameters = self._extract_parameters(code)
-            examples = await self._generate_usage_examples(code, requirement)
-            warnings = self._generate_warnings(code, security_level)
+            examples = await self._generate_usage_examples(code, requirement, use_cache)
+            warnings = self._generate_warnings(code, security_level, self._scan_security(code)[2])
             performance_notes = self._generate_performance_notes(code, complexity)
             
             return VBAMacro(
@@ -329,13 +625,56 @@ End Sub
             logger.error(f"Error generating macro: {str(e)}")
             raise
     
-    async def _analyze_requirement(self, requirement: str, context: Optional[Dict] = None) -> Dict:
+    def _template_macro(self, requirement: str) -> Optional[VBAMacro]:
+        """
+        Build a macro straight from a template, or None if no template fits
+        
+        Only simple requirements whose main operation has a "<operation>_data"
+        template and whose words ask for nothing beyond that operation qualify.
+        """
+        analysis = self._basic_requirement_analysis(requirement)
+        complexity = self._determine_complexity(requirement, analysis)
+        if complexity != MacroComplexity.SIMPLE:
+            return None
+        
+        main_op = analysis["main_operation"]
+        keywords = _OPERATION_WORDS.get(main_op)
+        if keywords is None or not _requirement_words(requirement) <= keywords | _TEMPLATE_FILLER_WORDS:
+            return None
+        
+        category = self._determine_category(requirement, analysis)
+        template_name = f"{main_op}_data"
+        template = self.vba_templates.get(_TEMPLATE_GROUP_BY_CATEGORY.get(category, "automation"), {}).get(template_name)
+        if template is None:
+            return None
+        
+        code = template.strip()
+        security_level = self._assess_security_level(code)
+        
+        return VBAMacro(
+            name=self._generate_macro_name(requirement, analysis),
+            code=code,
+            description=f"Applies the {template_name} template",
+            category=category,
+            complexity=complexity,
+            security_level=security_level,
+            dependencies=self._extract_dependencies(code),
+            parameters=self._extract_parameters(code),
+            usage_examples=["Run this macro from the VBA editor or assign it to a button"],
+            warnings=self._generate_warnings(code, security_level, self._scan_security(code)[2]),
+            performance_notes=self._generate_performance_notes(code, complexity)
+        )
+    
+    async def _analyze_requirement(self,
+                                   requirement: str,
+                                   context: Optional[Dict] = None,
+                                   use_cache: bool = True) -> Dict:
         """Analyze natural language requirement for macro generation"""
         prompt = f"""
         Analyze this VBA macro requirement and extract key information:
         
         Requirement: "{requirement}"
-        Context: {json.dumps(context, indent=2) if context else "None"}
+        Context: {_prompt_json(context) if context else "None"}
         
         Extract:
         1. Main action/operation
@@ -351,40 +690,23 @@ End Sub
         """
         
         try:
-            response = await self.ai_service.generate_response(prompt, max_tokens=500)
-            return json.loads(response)
+            response = await self._ask_ai(prompt, max_tokens=500, use_cache=use_cache)
+            return orjson.loads(response)
         except Exception as e:
             logger.warning(f"Could not analyze requirement with AI: {str(e)}")
             return self._basic_requirement_analysis(requirement)
     
     def _basic_requirement_analysis(self, requirement: str) -> Dict:
         """Basic keyword-based requirement analysis"""
-        requirement_lower = requirement.lower()
-        
-        operations = []
-        if any(word in requirement_lower for word in ['sort', 'order', 'arrange']):
-            operations.append('sort')
-        if any(word in requirement_lower for word in ['filter', 'search', 'find']):
-            operations.append('filter')
-        if any(word in requirement_lower for word in ['format', 'style', 'color']):
-            operations.append('format')
-        if any(word in requirement_lower for word in ['copy', 'duplicate', 'clone']):
-            operations.append('copy')
-        if any(word in requirement_lower for word in ['delete', 'remove', 'clear']):
-            operations.append('delete')
-        if any(word in requirement_lower for word in ['email', 'send', 'mail']):
-            operations.append('email')
-        if any(word in requirement_lower for word in ['save', 'export', 'output']):
-            operations.append('save')
-        if any(word in requirement_lower for word in ['chart', 'graph', 'plot']):
-            operations.append('chart')
+        words = _requirement_words(requirement)
+        operations = [operation for operation, keywords in _OPERATION_WORDS.items() if words & keywords]
         
         return {
             "main_operation": operations[0] if operations else "unknown",
             "operations": operations,
-            "has_user_input": any(word in requirement_lower for word in ['input', 'prompt', 'ask']),
-            "has_file_operations": any(word in requirement_lower for word in ['file', 'save', 'open', 'import', 'export']),
-            "has_external_access": any(word in requirement_lower for word in ['email', 'internet', 'web', 'api']),
+            "has_user_input": bool(words & _USER_INPUT_WORDS),
+            "has_file_operations": bool(words & _FILE_WORDS),
+            "has_external_access": bool(words & _EXTERNAL_WORDS),
             "complexity_indicators": len(operations)
         }
     
@@ -426,8 +748,7 @@ End Sub
             complexity_score += 1
         
         # Complex keywords
-        complex_keywords = ['loop', 'condition', 'if', 'array', 'dictionary', 'class']
-        if any(word in requirement.lower() for word in complex_keywords):
+        if _requirement_words(requirement) & _COMPLEX_WORDS:
             complexity_score += 2
         
         if complexity_score <= 1:
@@ -448,7 +769,7 @@ End Sub
         """Generate VBA macro code using AI"""
         
         # Get relevant templates
-        relevant_templates = self._get_relevant_templates(category, analysis)
+        relevant_templates = self._relevant_templates_json(category)
         
         prompt = f"""
         Generate a VBA macro for this requirement:
@@ -456,14 +777,14 @@ End Sub
         Requirement: "{requirement}"
         Category: {category.value}
         Complexity: {complexity.value}
-        Analysis: {json.dumps(analysis, indent=2)}
-        Constraints: {json.dumps(constraints, indent=2) if constraints else "None"}
+        Analysis: {_prompt_json(analysis)}
+        Constraints: {_prompt_json(constraints) if constraints else "None"}
         
         Relevant Templates:
-        {json.dumps(relevant_templates, indent=2)}
+        {relevant_templates}
         
         Best Practices:
-        {json.dumps(self.best_practices, indent=2)}
+        {self._best_practices_json}
         
         Requirements:
         1. Generate complete, working VBA code
@@ -488,49 +809,20 @@ End Sub
     
     def _get_relevant_templates(self, category: MacroCategory, analysis: Dict) -> Dict:
         """Get relevant macro templates for the category"""
-        category_map = {
-            MacroCategory.DATA_MANIPULATION: "data_manipulation",
-            MacroCategory.FORMATTING: "formatting",
-            MacroCategory.AUTOMATION: "automation",
-            MacroCategory.FILE_OPERATIONS: "file_operations",
-            MacroCategory.REPORTING: "reporting"
-        }
-        
-        template_key = category_map.get(category, "automation")
-        return self.vba_templates.get(template_key, {})
+        return self.vba_templates.get(_TEMPLATE_GROUP_BY_CATEGORY.get(category, "automation"), {})
+    
+    def _relevant_templates_json(self, category: MacroCategory) -> str:
+        """Relevant macro templates for the category, serialized for the generation prompt"""
+        return self._templates_json.get(_TEMPLATE_GROUP_BY_CATEGORY.get(category, "automation"), "{}")
     
     def _clean_generated_code(self, code: str) -> str:
         """Clean and format generated VBA code"""
         # Remove markdown formatting if present
-        code = re.sub(r'```vba\n?', '', code)
-        code = re.sub(r'```\n?', '', code)
+        code = _RE_VBA_FENCE.sub('', code)
+        code = _RE_CODE_FENCE.sub('', code)
         
         # Ensure proper indentation
-        lines = code.split('\n')
-        cleaned_lines = []
-        indent_level = 0
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                cleaned_lines.append('')
-                continue
-            
-            # Decrease indent for End statements
-            if line.startswith(('End ', 'Next', 'Loop', 'Wend')):
-                indent_level = max(0, indent_level - 1)
-            
-            # Add appropriate indentation
-            cleaned_lines.append('    ' * indent_level + line)
-            
-            # Increase indent for structure statements
-            if any(line.startswith(stmt) for stmt in [
-                'Sub ', 'Function ', 'If ', 'For ', 'Do ', 'While ', 
-                'With ', 'Select Case', 'Try'
-            ]):
-                indent_level += 1
-        
-        return '\n'.join(cleaned_lines)
+        return '\n'.join(_indent_vba_lines(code.split('\n')))
     
     def _generate_fallback_macro(self, requirement: str, analysis: Dict, category: MacroCategory) -> str:
         """Generate basic fallback macro when AI fails"""
@@ -579,27 +871,7 @@ End Sub'''
     
     def _assess_security_level(self, code: str) -> SecurityLevel:
         """Assess security level of generated macro"""
-        security_score = 0
-        
-        # Check for dangerous functions
-        for func in self.security_patterns["dangerous_functions"]:
-            if func in code:
-                security_score += 3
-        
-        # Check for risky patterns
-        for pattern in self.security_patterns["risky_patterns"]:
-            if re.search(pattern, code, re.IGNORECASE):
-                security_score += 2
-        
-        # Check for file operations
-        for pattern in self.security_patterns["file_operations"]:
-            if re.search(pattern, code, re.IGNORECASE):
-                security_score += 1
-        
-        # Check for external access
-        for pattern in self.security_patterns["external_access"]:
-            if re.search(pattern, code, re.IGNORECASE):
-                security_score += 2
+        security_score = self._scan_security(code)[0]
         
         if security_score == 0:
             return SecurityLevel.SAFE
@@ -610,6 +882,49 @@ End Sub'''
         else:
             return SecurityLevel.DANGEROUS
     
+    def _scan_security(self, code: str) -> Tuple[int, Tuple[str, ...], FrozenSet[str]]:
+        """
+        Score macro code against the security patterns and list its reportable issues
+        
+        Dangerous functions and risky patterns are reported; file operations
+        and external access only add to the score. The score is exact up to
+        the dangerous threshold, which is all the security level needs. The
+        reported functions and patterns that matched are also returned as a
+        set, so warnings can be derived without scanning the code again.
+        """
+        scan = self._security_scans.get(code)
+        if scan is not None:
+            return scan
+        
+        security_score = 0
+        issues = []
+        hits = set()
+        
+        # Check for dangerous functions
+        for func, pattern in self._dangerous_functions:
+            if pattern.search(code):
+                security_score += 3
+                issues.append(f"Uses potentially dangerous function: {func}")
+                hits.add(func)
+        
+        # Check for risky patterns, file operations and external access
+        for category, weight in _SECURITY_PATTERN_WEIGHTS.items():
+            reported = category == "risky_patterns"
+            # Past the highest threshold further matches cannot change the level
+            if security_score > 5 and not reported:
+                continue
+            for pattern, regex in self._compiled_security[category]:
+                if regex.search(code):
+                    security_score += weight
+                    if reported:
+                        issues.append(f"Contains risky pattern: {pattern}")
+                        hits.add(pattern)
+        
+        if len(self._security_scans) >= SECURITY_SCAN_CACHE_SIZE:
+            self._security_scans.clear()
+        scan = self._security_scans[code] = (security_score, tuple(issues), frozenset(hits))
+        return scan
+    
     def _generate_macro_name(self, requirement: str, analysis: Dict) -> str:
         """Generate appropriate macro name"""
         main_op = analysis.get("main_operation", "")
@@ -635,14 +950,18 @@ End Sub'''
         
         return base_name
     
-    async def _generate_description(self, requirement: str, code: str, analysis: Dict) -> str:
+    async def _generate_description(self,
+                                    requirement: str,
+                                    code: str,
+                                    analysis: Dict,
+                                    use_cache: bool = True) -> str:
         """Generate macro description"""
         prompt = f"""
         Generate a clear, concise description for this VBA macro:
         
         Original Requirement: "{requirement}"
         Generated Code: {code[:500]}...
-        Analysis: {json.dumps(analysis, indent=2)}
+        Analysis: {_prompt_json(analysis)}
         
         Provide a description that explains:
         1. What the macro does
@@ -654,48 +973,32 @@ End Sub'''
         """
         
         try:
-            return await self.ai_service.generate_response(prompt, max_tokens=200)
+            return await self._ask_ai(prompt, max_tokens=200, use_cache=use_cache)
         except Exception as e:
             logger.warning(f"Could not generate description: {str(e)}")
             return f"This macro automates the requested task: {requirement}"
     
     def _extract_dependencies(self, code: str) -> List[str]:
         """Extract dependencies from macro code"""
-        dependencies = []
+        # External objects, then references and add-ins
+        dependencies = list(_scan_code(code).created_objects)
+        dependencies.extend(dependency for marker, dependency in _DEPENDENCY_MARKERS if marker in code)
         
-        # Check for external objects
-        if "CreateObject" in code:
-            objects = re.findall(r'CreateObject\("([^"]+)"\)', code)
-            dependencies.extend(objects)
-        
-        # Check for references
-        if "References" in code:
-            dependencies.append("Additional References Required")
-        
-        # Check for add-ins
-        if "AddIns" in code:
-            dependencies.append("Excel Add-ins")
-        
-        return list(set(dependencies))
+        # Drop repeated objects, keeping first-seen order
+        return list(dict.fromkeys(dependencies))
     
     def _extract_parameters(self, code: str) -> List[Dict[str, str]]:
         """Extract parameters from macro code"""
         parameters = []
         
-        # Find Sub and Function declarations
-        patterns = [
-            r'Sub\s+\w+\s*\(([^)]+)\)',
-            r'Function\s+\w+\s*\(([^)]+)\)'
-        ]
-        
-        for pattern in patterns:
-            matches = re.findall(pattern, code)
-            for match in matches:
+        # Sub declarations first, then Function declarations
+        scan = _scan_code(code)
+        for declarations in (scan.sub_parameters, scan.function_parameters):
+            for match in declarations:
                 if match.strip():
-                    params = [p.strip() for p in match.split(',')]
-                    for param in params:
-                        parts = param.split(' As ')
-                        param_name = parts[0].strip()
+                    for param in match.split(','):
+                        parts = _RE_AS_CLAUSE.split(param.strip())
+                        param_name = parts[0]
                         param_type = parts[1].strip() if len(parts) > 1 else "Variant"
                         
                         parameters.append({
@@ -706,7 +1009,7 @@ End Sub'''
         
         return parameters
     
-    async def _generate_usage_examples(self, code: str, requirement: str) -> List[str]:
+    async def _generate_usage_examples(self, code: str, requirement: str, use_cache: bool = True) -> List[str]:
         """Generate usage examples for the macro"""
         prompt = f"""
         Generate 2-3 practical usage examples for this VBA macro:
@@ -723,33 +1026,29 @@ End Sub'''
         """
         
         try:
-            response = await self.ai_service.generate_response(prompt, max_tokens=300)
+            response = await self._ask_ai(prompt, max_tokens=300, use_cache=use_cache)
             examples = [line.strip() for line in response.split('\n') if line.strip()]
             return examples[:3]
         except Exception as e:
             logger.warning(f"Could not generate examples: {str(e)}")
             return ["Run this macro from the VBA editor or assign it to a button"]
     
-    def _generate_warnings(self, code: str, security_level: SecurityLevel) -> List[str]:
-        """Generate warnings based on code analysis"""
-        warnings = []
+    def _generate_warnings(self, code: str, security_level: SecurityLevel,
+                           hits: Optional[FrozenSet[str]] = None) -> List[str]:
+        """
+        Generate warnings based on code analysis
         
-        if security_level == SecurityLevel.DANGEROUS:
-            warnings.append("⚠️ DANGEROUS: This macro contains potentially harmful operations")
-        elif security_level == SecurityLevel.HIGH_RISK:
-            warnings.append("⚠️ HIGH RISK: Review this macro carefully before running")
-        elif security_level == SecurityLevel.MODERATE:
-            warnings.append("⚠️ MODERATE RISK: This macro performs system operations")
+        hits is the match set from the security scan of the same code; it is
+        looked up from the scan cache when not given.
+        """
+        if hits is None:
+            hits = self._scan_security(code)[2]
+        
+        level_warning = _SECURITY_LEVEL_WARNINGS.get(security_level)
+        warnings = [level_warning] if level_warning else []
         
         # Check for specific risks
-        if "Shell" in code:
-            warnings.append("This macro executes external programs")
-        if "CreateObject" in code:
-            warnings.append("This macro creates external objects")
-        if "FileSystem" in code:
-            warnings.append("This macro modifies files or folders")
-        if "EnableEvents" in code and "False" in code:
-            warnings.append("This macro disables Excel events")
+        warnings.extend(message for tokens, message in _RISK_WARNING_RULES if not tokens.isdisjoint(hits))
         
         return warnings
     
@@ -757,37 +1056,27 @@ End Sub'''
         """Generate performance notes"""
         notes = []
         
-        if complexity in [MacroComplexity.COMPLEX, MacroComplexity.ADVANCED]:
+        if complexity in (MacroComplexity.COMPLEX, MacroComplexity.ADVANCED):
             notes.append("Complex macro - may take longer to execute")
         
-        if "ScreenUpdating" in code and "False" in code:
-            notes.append("Screen updating disabled for better performance")
-        
-        if "UsedRange" in code:
-            notes.append("Performance depends on data size")
-        
-        if "Loop" in code or "For" in code:
-            notes.append("Contains loops - execution time varies with data")
-        
-        if "AutoFilter" in code:
-            notes.append("Uses AutoFilter - ensure data is properly formatted")
+        notes.extend(note for applies, note in _PERFORMANCE_NOTE_RULES if applies(code))
         
         return notes
 
     async def analyze_macro(self, code: str, context: Optional[Dict] = None) -> MacroAnalysis:
         """Analyze existing VBA macro code"""
         try:
-            # Security analysis
+            # Security analysis, the only step that asks the AI
             security_issues = await self._analyze_security(code)
             
             # Performance analysis
-            performance_issues = await self._analyze_performance(code)
+            performance_issues = self._analyze_performance(code)
             
             # Best practices check
-            best_practices = await self._check_best_practices(code)
+            best_practices = self._check_best_practices(code)
             
             # Optimization suggestions
-            optimizations = await self._suggest_optimizations(code)
+            optimizations = self._suggest_optimizations(code)
             
             # Quality scores
             code_quality = self._calculate_code_quality(code)
@@ -810,47 +1099,79 @@ End Sub'''
             logger.error(f"Error analyzing macro: {str(e)}")
             raise
     
-    async def _analyze_security(self, code: str) -> List[str]:
-        """Analyze security issues in macro code"""
-        issues = []
+    async def analyze_macros(self, codes: List[str], context: Optional[Dict] = None) -> List[MacroAnalysis]:
+        """
+        Analyze several macros concurrently, in the order given
         
-        # Check dangerous functions
-        for func in self.security_patterns["dangerous_functions"]:
-            if func in code:
-                issues.append(f"Uses potentially dangerous function: {func}")
+        At most MACRO_ANALYSIS_CONCURRENCY analyses run at once, and their AI
+        security reviews share batched requests.
+        """
+        semaphore = asyncio.Semaphore(MACRO_ANALYSIS_CONCURRENCY)
+        
+        async def analyze(code: str) -> MacroAnalysis:
+            async with semaphore:
+                return await self.analyze_macro(code, context)
         
-        # Check risky patterns
-        for pattern in self.security_patterns["risky_patterns"]:
-            if re.search(pattern, code, re.IGNORECASE):
-                issues.append(f"Contains risky pattern: {pattern}")
+        return list(await asyncio.gather(*(analyze(code) for code in codes)))
+    
+    async def _analyze_security(self, code: str) -> List[str]:
+        """Analyze security issues in macro code"""
+        # Dangerous functions and risky patterns
+        issues = list(self._scan_security(code)[1])
         
-        # Use AI for advanced analysis
+        # Use AI for advanced analysis; concurrent reviews are batched
         try:
-            prompt = f"""
-            Analyze this VBA code for security vulnerabilities:
-            
-            Code: {code[:1000]}...
-            
-            Look for:
-            1. File system access
-            2. External program execution
-            3. Network access
-            4. Registry modifications
-            5. Privilege escalation
-            6. Data exposure risks
-            
-            Return list of security concerns.
-            """
-            
-            response = await self.ai_service.generate_response(prompt, max_tokens=300)
-            ai_issues = [line.strip() for line in response.split('\n') if line.strip()]
-            issues.extend(ai_issues)
+            issues.extend(await self._security_review_batcher.submit(code))
         except Exception as e:
             logger.warning(f"AI security analysis failed: {str(e)}")
         
         return list(set(issues))
     
-    async def _analyze_performance(self, code: str) -> List[str]:
+    def _security_review_prompt(self, codes: List[str]) -> str:
+        """Build the AI security review prompt for one or more macros"""
+        if len(codes) == 1:
+            return _SECURITY_REVIEW_TEMPLATE.format(
+                subject="this VBA code",
+                macros=f"\n            Code: {codes[0][:1000]}...",
+                output="Return list of security concerns."
+            )
+        
+        return _SECURITY_REVIEW_TEMPLATE.format(
+            subject=f"each of these {len(codes)} VBA macros",
+            macros="".join(
+                f"\n            Macro #{index}:\n            Code: {code[:1000]}..."
+                for index, code in enumerate(codes)
+            ),
+            output=_SECURITY_REVIEW_BATCH_OUTPUT
+        )
+    
+    async def _review_security_batch(self, codes: List[str]) -> List[List[str]]:
+        """
+        Ask the AI for security concerns of a batch of macros in one request
+        
+        A single macro gets the plain prompt and one concern per reply line.
+        If a batched reply cannot be read, the macros are reviewed one by one.
+        """
+        prompt = self._security_review_prompt(codes)
+        response = await self.ai_service.generate_response(
+            prompt, max_tokens=min(SECURITY_REVIEW_MAX_TOKENS * len(codes), server_config.ai_batch_max_tokens)
+        )
+        if len(codes) == 1:
+            return [[line.strip() for line in response.split('\n') if line.strip()]]
+        
+        try:
+            parsed = decode_first(response)
+            if not isinstance(parsed, list) or len(parsed) != len(codes) or \
+                    not all(isinstance(entry, list) for entry in parsed):
+                raise ValueError(f"Expected security concerns for {len(codes)} macros")
+        except ValueError as e:
+            logger.warning(f"Batched security review unreadable, reviewing macros separately: {str(e)}")
+            reviews = await asyncio.gather(*(self._review_security_batch([code]) for code in codes))
+            return [review[0] for review in reviews]
+        
+        return [[str(concern).strip() for concern in entry if str(concern).strip()] for entry in parsed]
+    
+    def _analyze_performance(self, code: str) -> List[str]:
         """Analyze performance issues in macro code"""
         issues = []
         
@@ -869,7 +1190,7 @@ End Sub'''
         
         return issues
     
-    async def _check_best_practices(self, code: str) -> List[str]:
+    def _check_best_practices(self, code: str) -> List[str]:
         """Check adherence to VBA best practices"""
         practices = []
         
@@ -891,7 +1212,7 @@ End Sub'''
         
         return practices
     
-    async def _suggest_optimizations(self, code: str) -> List[str]:
+    def _suggest_optimizations(self, code: str) -> List[str]:
         """Suggest code optimizations"""
         suggestions = []
         
@@ -1012,7 +1333,7 @@ End Sub'''
         - Security Issues: {len(analysis.security_issues)}
         
         Issues to Address:
-        {json.dumps(analysis.performance_issues + analysis.best_practices, indent=2)}
+        {_prompt_json(analysis.performance_issues + analysis.best_practices)}
         
         Optimization Goals: {goals if goals else "General performance and best practices"}
         